@@ -0,0 +1,196 @@
+# Benchmarks. Those that use the database must be run against a scratch one,
+# NOT production data:
+#     python3 benchmark.py [name ...]
+# With no names, runs everything. Each database benchmark seeds its own data
+# under a reserved Twitch ID and removes it again afterwards.
+import os
+import sys
+import time
+
+try:
+	import config
+except ImportError:
+	# As per mustard.py, but only the database matters here
+	import config_sample as config
+	config.DATABASE_URI = os.environ.get("DATABASE_URI") or os.environ.get("DATABASE_URL")
+	sys.modules["config"] = config
+
+database = None # Imported only if needed, as it connects on import
+
+BENCH_TWITCHID = 2000000000 # Well above any real Twitch user ID (for now), but still fits in an integer
+BENCHMARKS = {}
+def benchmark(f=None, *, db=True):
+	if f is None: return lambda f: benchmark(f, db=db)
+	f.needs_db = db
+	BENCHMARKS[f.__name__] = f
+	return f
+
+def timeit(desc, func, n=500):
+	func() # Warm up
+	start = time.perf_counter()
+	for _ in range(n): func()
+	per = (time.perf_counter() - start) / n
+	print("%-40s %8.3f ms" % (desc, per * 1000))
+	return per
+
+def cleanup(twitchid=BENCH_TWITCHID):
+	with database.cursor() as cur:
+		cur.execute("delete from mustard.setups where twitchid=%s", (twitchid,))
+		cur.execute("delete from mustard.timers where twitchid=%s", (twitchid,))
+		cur.execute("delete from mustard.users where twitchid=%s", (twitchid,))
+
+def seed(twitchid=BENCH_TWITCHID, setups=20, timers=5):
+	cleanup(twitchid)
+	with database.cursor() as cur:
+		cur.execute("insert into mustard.users (twitchid, checklist) values (%s, 'One\nTwo\nThree')", (twitchid,))
+		for i in range(setups):
+			cur.execute("insert into mustard.setups (twitchid, category, title) values (%s, 'Art', %s)", (twitchid, "Setup %d" % i))
+		for i in range(timers):
+			cur.execute("insert into mustard.timers (id, twitchid, title) values (%s, %s, %s)",
+				(database.generate_timer_id(), twitchid, "Timer %d" % i))
+
+@benchmark
+def dashboard():
+	"""Landing page reads: four separate transactions vs load_dashboard()
+
+	Each separate call costs three round trips (BEGIN, the query, COMMIT),
+	so the old way is twelve round trips per page load and the new way three.
+	"""
+	seed()
+	try:
+		def separate():
+			database.get_twitter_config(BENCH_TWITCHID)
+			database.list_setups(BENCH_TWITCHID)
+			database.get_checklist(BENCH_TWITCHID)
+			database.list_timers(BENCH_TWITCHID)
+		before = timeit("Separate queries (4 transactions)", separate)
+		after = timeit("load_dashboard (1 transaction)", lambda: database.load_dashboard(BENCH_TWITCHID))
+		print("Speedup: %.1fx" % (before / after))
+	finally:
+		cleanup()
+
+@benchmark
+def restore():
+	"""Restoring a backup with 1000 setups: one INSERT per setup vs bulk statements"""
+	seed(setups=0)
+	backup = {
+		"setups": [{"category": "Art", "title": "Setup %d" % i, "tags": "Tag", "tweet": "Going live!"} for i in range(1000)] + [""],
+		"checklist": ["One", "Two", "Three", ""],
+		"timers": [{"id": "bench%d" % i, "title": "Timer %d" % i} for i in range(50)] + [""],
+	}
+	try:
+		def per_row():
+			# The way Restorer used to do it
+			with database.cursor() as cur:
+				cur.execute("delete from mustard.setups where twitchid = %s", (BENCH_TWITCHID,))
+				for setup in backup["setups"][:-1]:
+					cur.execute("insert into mustard.setups (twitchid, category, title, tags, tweet, ccls) values (%s, %s, %s, %s, %s, %s) returning id",
+						(BENCH_TWITCHID, setup["category"], setup["title"], setup["tags"], setup["tweet"], ""))
+		def bulk():
+			r = database.restore_from_json(BENCH_TWITCHID, backup)
+			assert not r.failed, r.summary
+		before = timeit("One INSERT per setup", per_row, n=20)
+		after = timeit("restore_from_json (bulk)", bulk, n=20)
+		print("Speedup: %.1fx (and the bulk version did timers too)" % (before / after))
+	finally:
+		cleanup()
+
+@benchmark
+def indexes():
+	"""Query plans for per-user lookups, with and without the twitchid indexes
+
+	Seeds 10,000 users with ten setups and two timers each, then explains the
+	hot queries. The "without" run drops the indexes inside a transaction that
+	then gets rolled back, so the schema is left as it was.
+	"""
+	users = 10000
+	queries = [
+		("list_setups", "select * from mustard.setups where twitchid=%s order by id"),
+		("list_timers", "select id, title from mustard.timers where twitchid=%s order by id"),
+		("Restorer", "select id from mustard.timers where twitchid=%s"),
+	]
+	def explain(cur):
+		for desc, query in queries:
+			cur.execute("explain analyze " + query, (BENCH_TWITCHID + users // 2,))
+			print("  " + desc)
+			for line, in cur: print("    " + line)
+	with database.cursor() as cur:
+		cur.execute("insert into mustard.users (twitchid) select generate_series(%s, %s)", (BENCH_TWITCHID, BENCH_TWITCHID + users - 1))
+		cur.execute("""insert into mustard.setups (twitchid, category, title)
+			select u, 'Art', 'Setup ' || n from generate_series(%s, %s) u, generate_series(1, 10) n""",
+			(BENCH_TWITCHID, BENCH_TWITCHID + users - 1))
+		cur.execute("""insert into mustard.timers (id, twitchid, title)
+			select 'bench' || u || '-' || n, u, 'Timer' from generate_series(%s, %s) u, generate_series(1, 2) n""",
+			(BENCH_TWITCHID, BENCH_TWITCHID + users - 1))
+	try:
+		with database.cursor() as cur:
+			cur.execute("analyze mustard.setups"); cur.execute("analyze mustard.timers")
+		with database.pool.connection() as conn, conn.cursor() as cur:
+			try:
+				for index in database.INDEXES: cur.execute("drop index mustard." + index)
+				print("Without indexes:")
+				explain(cur)
+			finally:
+				conn.rollback()
+		with database.cursor() as cur:
+			print("With indexes:")
+			explain(cur)
+	finally:
+		with database.cursor() as cur:
+			for table in ("setups", "timers", "users"):
+				cur.execute("delete from mustard." + table + " where twitchid between %s and %s", (BENCH_TWITCHID, BENCH_TWITCHID + users - 1))
+
+@benchmark
+def prepared():
+	"""The hot public queries, ad-hoc vs prepared"""
+	seed()
+	try:
+		timerid = database.list_timers(BENCH_TWITCHID)[0][0]
+		adhoc = {
+			"list_setups": "select * from mustard.setups where twitchid=%s order by id",
+			"list_timers": "select id, title from mustard.timers where twitchid=%s order by id",
+			"get_timer_details": "select * from mustard.timers where id=%s",
+		}
+		args = {"list_setups": BENCH_TWITCHID, "list_timers": BENCH_TWITCHID, "get_timer_details": timerid}
+		# Time many queries within one transaction, to measure the queries rather than BEGIN/COMMIT
+		with database.cursor() as cur:
+			for name, query in adhoc.items():
+				def run_adhoc():
+					cur.execute(query, (args[name],)); cur.fetchall()
+				def run_prepared():
+					database.execute_prepared(cur, name, args[name]); cur.fetchall()
+				before = timeit(name + " (ad-hoc)", run_adhoc, n=2000)
+				after = timeit(name + " (prepared)", run_prepared, n=2000)
+				print("%-40s %8.2fx" % ("", before / after))
+	finally:
+		cleanup()
+
+@benchmark(db=False)
+def scheduler():
+	"""Listing and cancelling with 100,000 queued jobs, by owner vs by scanning"""
+	import utils
+	sched = utils.Scheduler()
+	owners = [("token%d" % i, "secret%d" % i) for i in range(10000)]
+	def job(cred, tweet): pass
+	future = time.time() + 86400 # Nothing will come due during the benchmark
+	start = time.perf_counter()
+	for i in range(100000):
+		cred = owners[i % len(owners)]
+		sched.put(future + i, job, cred, "Tweet %d" % i, owner=cred)
+	print("%-40s %8.3f ms" % ("Queue 100,000 jobs", (time.perf_counter() - start) * 1000))
+	cred = owners[1234]
+	timeit("List one owner's jobs (full scan)", lambda: [j for j in sched.search(job) if j[2][0] == cred], n=20)
+	timeit("List one owner's jobs (indexed)", lambda: sched.search(job, owner=cred), n=2000)
+	ids = iter(range(1, 100001))
+	def cancel():
+		id = next(ids)
+		sched.remove(id, owner=owners[(id - 1) % len(owners)])
+	timeit("Cancel a job (indexed)", cancel, n=60000)
+	print("Queue entries after cancelling 60,000: %d (compaction keeps dead entries bounded)" % len(sched.queue.queue))
+
+if __name__ == "__main__":
+	names = sys.argv[1:] or BENCHMARKS
+	if any(BENCHMARKS[name].needs_db for name in names): import database
+	for name in names:
+		print("----", name)
+		BENCHMARKS[name]()
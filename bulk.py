@@ -0,0 +1,134 @@
+# Instance-wide dump and restore of all Mustard Mine data, for moving hosts.
+#     python3 bulk.py dump mustard.dump.gz
+#     python3 bulk.py load mustard.dump.gz [--replace]
+# Uses the same configuration as the main app (config.py or the environment).
+#
+# The archive is a gzipped stream of sections, one per table, each being a
+# header line giving the table and its columns, then the rows in Postgres's
+# COPY text format, terminated by the usual "\." line. Everything is streamed
+# both ways, so memory usage is constant no matter how many rows there are.
+import argparse
+import gzip
+import os
+import sys
+import time
+
+try:
+	import config
+except ImportError:
+	# As per mustard.py, but only the database matters here
+	import config_sample as config
+	config.DATABASE_URI = os.environ.get("DATABASE_URI") or os.environ.get("DATABASE_URL")
+	sys.modules["config"] = config
+
+import database
+
+# The tables that hold user data, in foreign-key order. Pending tweets move too,
+# and will be sent by the new host's sweep if they fall due during the move.
+# (The others are status, a singleton, and games, a cache of Twitch lookups.)
+DUMP_TABLES = ["users", "setups", "timers", "scheduled_jobs"]
+SERIAL_TABLES = ["setups", "scheduled_jobs"] # Tables whose IDs come from a sequence
+HEADER = "-- mustard table "
+PROGRESS_EVERY = 100000 # Rows
+
+class Progress:
+	"""Count rows as they pass, reporting every so often"""
+	def __init__(self, table):
+		self.table = table
+		self.rows = 0
+		self.start = time.monotonic()
+
+	def count(self, rows):
+		before = self.rows
+		self.rows += rows
+		if self.rows // PROGRESS_EVERY != before // PROGRESS_EVERY:
+			self.report("...")
+
+	def report(self, suffix=""):
+		print("%s: %d rows in %.1fs%s" % (self.table, self.rows, time.monotonic() - self.start, suffix), file=sys.stderr)
+
+class DumpWriter:
+	"""File-like target for COPY TO, passing data through to the archive"""
+	def __init__(self, out, progress):
+		self.out = out
+		self.progress = progress
+
+	def write(self, data):
+		if isinstance(data, str): data = data.encode("utf-8")
+		self.out.write(data)
+		self.progress.count(data.count(b"\n"))
+
+class SectionReader:
+	"""File-like source for COPY FROM, reading one section of the archive"""
+	def __init__(self, archive, progress):
+		self.archive = archive
+		self.progress = progress
+		self.done = False
+
+	def readline(self, size=-1):
+		if self.done: return b""
+		line = self.archive.readline()
+		if not line: raise ValueError("Archive truncated in table " + self.progress.table)
+		if line == b"\\.\n":
+			self.done = True
+			return b""
+		self.progress.count(1)
+		return line
+
+	def read(self, size=-1):
+		# psycopg2 reads in blocks; give it whole lines, roughly that much at a time
+		lines = []; total = 0
+		while size < 0 or total < size:
+			line = self.readline()
+			if not line: break
+			lines.append(line); total += len(line)
+		return b"".join(lines)
+
+def dump(fn):
+	with gzip.open(fn, "wb") as out, database.pool.connection() as conn, conn, conn.cursor() as cur:
+		# One repeatable-read snapshot, so the tables are consistent with each other
+		cur.execute("set transaction isolation level repeatable read, read only")
+		for table in DUMP_TABLES:
+			columns = database.columns(table)
+			out.write(("%s%s (%s)\n" % (HEADER, table, columns)).encode("utf-8"))
+			progress = Progress(table)
+			cur.copy_expert("copy mustard.%s (%s) to stdout" % (table, columns), DumpWriter(out, progress))
+			out.write(b"\\.\n")
+			progress.report()
+
+def load(fn, replace=False):
+	with gzip.open(fn, "rb") as archive, database.pool.connection() as conn, conn, conn.cursor() as cur:
+		cur.execute("select exists (select 1 from mustard.users)")
+		if cur.fetchone()[0]:
+			if not replace: sys.exit("Database already has users - use --replace to wipe them first")
+			cur.execute("truncate " + ", ".join("mustard." + t for t in DUMP_TABLES))
+		while True:
+			line = archive.readline().decode("utf-8")
+			if not line: break
+			if not line.startswith(HEADER): raise ValueError("Malformed archive - expected a table header, got %r" % line[:100])
+			table, columns = line[len(HEADER):].strip().split(" ", 1)
+			if table not in DUMP_TABLES: raise ValueError("Malformed archive - unknown table %r" % table)
+			# Columns come from the archive, so that an older dump can load into a newer
+			# schema; any column added since then will take its default.
+			want = {c.split()[0] for c in database.TABLES[table]}
+			if not set(columns.strip("()").replace(" ", "").split(",")) <= want:
+				raise ValueError("Archive has columns %s for table %s, which doesn't match this schema" % (columns, table))
+			progress = Progress(table)
+			cur.copy_expert("copy mustard.%s %s from stdin" % (table, columns), SectionReader(archive, progress))
+			progress.report()
+		# Rows came in with their IDs, so move the sequences past them
+		for table in SERIAL_TABLES:
+			cur.execute("select setval(pg_get_serial_sequence('mustard.%s', 'id'), coalesce(max(id), 0) + 1, false) from mustard.%s" % (table, table))
+		# Any worker already running has cached the timers (and knows of the
+		# users) that were here before
+		database.timers_changed(cur, [database.TIMER_FLUSH])
+	print("Committed.", file=sys.stderr)
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Dump or load all Mustard Mine user data")
+	parser.add_argument("action", choices=["dump", "load"])
+	parser.add_argument("file", help="Archive file (gzipped)")
+	parser.add_argument("--replace", action="store_true", help="When loading, wipe all existing users first")
+	args = parser.parse_args()
+	if args.action == "dump": dump(args.file)
+	else: load(args.file, args.replace)
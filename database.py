@@ -1,24 +1,240 @@
 import psycopg2.extras
 import config
 import contextlib
+import copy
+import hashlib
 import collections
 import json
 import os
 import base64
+import threading
+import time
+import select
 import pytz
+import utils
 from datetime import datetime, timedelta
 
-# NOTE: We use one single connection per process, but every function in this module
-# creates its own dedicated cursor. This means that these functions should be thread
-# safe; psycopg2 has thread-safe connections but not thread-safe cursors.
-assert psycopg2.threadsafety >= 2
-postgres = psycopg2.connect(config.DATABASE_URI)
+# Under gevent, make psycopg2 yield to the hub while it waits on the server,
+# instead of blocking every greenlet in the process. (This is what psycogreen
+# does; it's short enough to not be worth the dependency.)
+from gevent import monkey
+if monkey.is_module_patched("socket"):
+	from gevent.socket import wait_read, wait_write
+	def gevent_wait_callback(conn, timeout=None):
+		while True:
+			state = conn.poll()
+			if state == psycopg2.extensions.POLL_OK: break
+			elif state == psycopg2.extensions.POLL_READ: wait_read(conn.fileno(), timeout=timeout)
+			elif state == psycopg2.extensions.POLL_WRITE: wait_write(conn.fileno(), timeout=timeout)
+			else: raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+	psycopg2.extensions.set_wait_callback(gevent_wait_callback)
+
+class Connection(psycopg2.extensions.connection):
+	"""A database connection that knows which statements it has prepared"""
+	def __init__(self, *a, **kw):
+		super().__init__(*a, **kw)
+		self.prepared = set()
+
+class PoolTimeout(Exception): pass
+class ConnectionPool:
+	"""Bounded pool of database connections
+
+	Every function in this module checks out a connection for the duration of
+	one transaction, and returns it afterwards. When all connections are busy,
+	callers wait their turn (cooperatively, if gevent is in use). Connections
+	that have been idle for a while are pinged before reuse, and any that
+	turn out to have been dropped are replaced with fresh ones.
+	"""
+	def __init__(self, dsn, *, size=10, timeout=30, ping_after=60):
+		self.dsn = dsn
+		self.size = size
+		self.timeout = timeout # Max seconds to wait for a free connection
+		self.ping_after = ping_after # Check connections idle for longer than this
+		self.slots = threading.BoundedSemaphore(size)
+		self.idle = [] # (connection, time returned) - used as a stack, so warm ones get reused
+		self.lock = threading.Lock()
+		self.created = self.reconnects = self.waits = self.in_use = 0
+
+	def _connect(self):
+		self.created += 1
+		return psycopg2.connect(self.dsn, connection_factory=Connection)
+
+	def _healthy(self, conn, idle_since):
+		if conn.closed: return False
+		if time.time() - idle_since < self.ping_after: return True
+		try:
+			with conn, conn.cursor() as cur: cur.execute("select 1")
+			return True
+		except psycopg2.Error:
+			return False
+
+	def getconn(self):
+		if not self.slots.acquire(blocking=False):
+			self.waits += 1
+			if not self.slots.acquire(timeout=self.timeout):
+				raise PoolTimeout("No database connection available after %d seconds" % self.timeout)
+		try:
+			conn = None
+			while conn is None:
+				with self.lock:
+					if not self.idle: break
+					conn, idle_since = self.idle.pop()
+				if not self._healthy(conn, idle_since):
+					# Dropped by the server (or the network). Replace it.
+					self.reconnects += 1
+					conn.close()
+					conn = None
+			if conn is None: conn = self._connect()
+		except BaseException:
+			self.slots.release()
+			raise
+		self.in_use += 1
+		return conn
+
+	def putconn(self, conn):
+		self.in_use -= 1
+		if not conn.closed and conn.status != psycopg2.extensions.STATUS_READY:
+			try: conn.rollback() # Shouldn't happen, as every user commits or rolls back
+			except psycopg2.Error: conn.close()
+		if not conn.closed:
+			with self.lock: self.idle.append((conn, time.time()))
+		self.slots.release()
+
+	@contextlib.contextmanager
+	def connection(self):
+		conn = self.getconn()
+		try: yield conn
+		finally: self.putconn(conn)
+
+	def stats(self):
+		return {"size": self.size, "in_use": self.in_use, "idle": len(self.idle),
+			"waits": self.waits, "created": self.created, "reconnects": self.reconnects}
+
+# Each function in this module runs as a single transaction on its own pooled
+# connection, with its own dedicated cursor.
+pool = ConnectionPool(config.DATABASE_URI, size=int(os.environ.get("DATABASE_POOL_SIZE", "10")))
+
+@contextlib.contextmanager
+def cursor(cursor_factory=None):
+	"""Check out a connection and open a transaction; yields a cursor
+
+	The transaction is committed if the block completes, and rolled back
+	if it raises.
+	"""
+	with pool.connection() as conn, conn, conn.cursor(cursor_factory=cursor_factory) as cur:
+		yield cur
+
+class Listener:
+	"""Deliver Postgres notifications to callbacks in this process
+
+	Uses one dedicated connection (outside the pool), serviced by a daemon
+	thread once start() is called. If that connection drops, it's replaced,
+	and anything registered with on_reconnect() gets called, since any
+	notifications sent in the meantime will have been missed.
+
+	Only that thread ever uses the connection. LISTEN/UNLISTEN requests from
+	elsewhere are queued for it and it's woken up to run them, as running a
+	command can read in pending notifications that the thread, waiting on
+	the socket, would otherwise not notice until something else arrived.
+	"""
+	def __init__(self, dsn):
+		self.dsn = dsn
+		self.callbacks = collections.defaultdict(list) # Channel name: [callback(payload)]
+		self.reconnect_callbacks = []
+		self.conn = None
+		self.thread = None
+		self.lock = threading.Lock() # Guards callbacks and commands
+		self.commands = [] # (command, channel) to run on the listener's thread
+		self.wakeup_read, self.wakeup_write = os.pipe()
+		os.set_blocking(self.wakeup_write, False)
+
+	def _queue(self, command, channel):
+		# Must be called with the lock held. If not yet connected, the channel
+		# will be picked up from the callbacks when we do connect.
+		if not self.thread: return
+		self.commands.append((command, channel))
+		try: os.write(self.wakeup_write, b"x")
+		except BlockingIOError: pass # Pipe's full, so it's already due to wake up
+
+	def _execute(self, command, channel):
+		# Channel names are always our own.
+		with self.conn.cursor() as cur: cur.execute('%s "%s"' % (command, channel))
+
+	def listen(self, channel, callback):
+		with self.lock:
+			if not self.callbacks[channel]: self._queue("listen", channel)
+			self.callbacks[channel].append(callback)
+
+	def unlisten(self, channel, callback):
+		with self.lock:
+			self.callbacks[channel].remove(callback)
+			if not self.callbacks[channel]:
+				del self.callbacks[channel]
+				self._queue("unlisten", channel)
+
+	def on_reconnect(self, callback):
+		self.reconnect_callbacks.append(callback)
+
+	def start(self):
+		with self.lock:
+			if self.thread: return
+			self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self):
+		first = True
+		while True:
+			try:
+				self.conn = psycopg2.connect(self.dsn)
+				self.conn.autocommit = True
+				with self.lock:
+					# A fresh connection listens on everything current, so
+					# anything queued before now is already covered.
+					channels = list(self.callbacks)
+					self.commands = []
+				for channel in channels: self._execute("listen", channel)
+				if not first:
+					for callback in self.reconnect_callbacks: callback()
+				first = False
+				while True:
+					ready, _, _ = select.select([self.conn, self.wakeup_read], [], [], 60)
+					if self.wakeup_read in ready: os.read(self.wakeup_read, 4096)
+					with self.lock:
+						commands = self.commands
+						self.commands = []
+					for command in commands: self._execute(*command)
+					# Notifications may have been read in by those commands as
+					# well as by the poll, so always collect them afterwards.
+					self.conn.poll()
+					notifies = self.conn.notifies[:]
+					del self.conn.notifies[:]
+					for notify in notifies:
+						# Copied, as callbacks can yield, and others may (un)listen meanwhile
+						for callback in list(self.callbacks.get(notify.channel, ())):
+							try: callback(notify.payload)
+							except Exception as e: print("Exception in notification callback:", repr(e))
+			except Exception as e: # Most likely psycopg2.Error, but select() can fail too
+				print("Lost notification connection, reconnecting:", repr(e))
+				try: self.conn.close()
+				except Exception: pass
+				time.sleep(5)
+
+listener = Listener(config.DATABASE_URI)
+
+def notify(cur, channel, payloads):
+	"""Queue notifications, which will be sent when the transaction commits"""
+	cur.execute("select pg_notify(%s, p) from unnest(%s::text[]) p", (channel, list(payloads)))
+
+def publish(channel, payload):
+	"""Send one notification to every process listening on that channel"""
+	with cursor() as cur: notify(cur, channel, [payload])
 
 # Assumes that dict preserves insertion order (CPython 3.6+, other Python 3.7+, possible 3.5)
 # Otherwise, tables might be created in the wrong order, breaking foreign key refs.
 TABLES = {
 	"status": [ # Singleton table
 		"tags_updated timestamptz not null default '1970-1-1Z'", # No longer needed as of 20220127
+		"schema_version text not null default ''", # See create_tables()
 	],
 	"users": [
 		"twitchid integer primary key",
@@ -42,8 +258,54 @@ TABLES = {
 		"maxtime integer not null default 3600", # If time to event exceeds this, shows "NOW"
 		"styling text not null default ''", # CSS - set by eg color selection
 	],
+	"scheduled_jobs": [ # Tweets waiting to be sent. Rows are deleted once sent.
+		"id serial primary key",
+		"due timestamptz not null",
+		"token text not null", # Twitter OAuth credentials to send with
+		"secret text not null",
+		"tweet json not null", # Either a string or a list of strings (a thread)
+	],
+	"games": [ # Cache of Twitch category names, which almost never change IDs
+		"name text primary key",
+		"id text not null",
+		"boxart text not null default ''",
+	],
+}
+
+# Secondary indexes, by name. Like columns, these get created and dropped as
+# needed to match this list; but since they're matched up by name only, any
+# change to an index's definition must come with a new name.
+INDEXES = {
+	"setups_twitchid_id": "setups (twitchid, id)",
+	"timers_twitchid_id": "timers (twitchid, id)",
+	"scheduled_jobs_due": "scheduled_jobs (due)",
+	"scheduled_jobs_token": "scheduled_jobs (token, due)",
+}
+
+def columns(table):
+	return ", ".join(c.split()[0] for c in TABLES[table])
+
+# Hot read queries, prepared on each connection the first time they're used
+# there. Prepared statements belong to the connection, so a replacement for
+# a dropped connection starts with none and re-prepares them as needed.
+# Columns are listed explicitly, as a prepared "select *" breaks when the
+# table gains or loses a column.
+PREPARED = {
+	"list_setups": ("integer", "select " + columns("setups") + " from mustard.setups where twitchid=$1 order by id"),
+	"list_timers": ("integer", "select id, title from mustard.timers where twitchid=$1 order by id"),
+	"list_timers_full": ("integer", "select id, title, delta, maxtime, styling from mustard.timers where twitchid=$1 order by id"),
+	"get_timer_details": ("text", "select " + columns("timers") + " from mustard.timers where id=$1"),
 }
 
+def execute_prepared(cur, name, *args):
+	"""Like cur.execute() but for one of the PREPARED queries"""
+	conn = cur.connection
+	if name not in conn.prepared:
+		types, query = PREPARED[name]
+		cur.execute("prepare %s (%s) as %s" % (name, types, query))
+		conn.prepared.add(name)
+	cur.execute("execute %s (%s)" % (name, ", ".join(["%s"] * len(args))), args)
+
 # https://postgrespro.com/list/thread-id/1544890
 # Allow <<DEFAULT>> to be used as a value in an insert statement
 class Default(object):
@@ -53,8 +315,36 @@ class Default(object):
 DEFAULT = Default()
 del Default
 
+# Changing TABLES or INDEXES changes the version, which tells create_tables() to
+# bring the database into line with them. Until then, startup costs one query.
+SCHEMA_VERSION = hashlib.sha1(json.dumps([TABLES, INDEXES]).encode("ascii")).hexdigest()
+SCHEMA_LOCK = 0x6d757374 # Advisory lock ID, arbitrary but unique to us
+
+def _schema_current(cur):
+	# In a savepoint, so that a failed lookup doesn't abort the caller's transaction
+	cur.execute("savepoint schema_check")
+	try:
+		cur.execute("select schema_version from mustard.status")
+		row = cur.fetchone()
+	except psycopg2.ProgrammingError:
+		# No schema, no status table, or no version column - definitely not current
+		cur.execute("rollback to savepoint schema_check")
+		return False
+	cur.execute("release savepoint schema_check")
+	return row is not None and row[0] == SCHEMA_VERSION
+
+def schema_current():
+	"""Check whether the database schema matches this code's version"""
+	with cursor() as cur: return _schema_current(cur)
+
 def create_tables():
-	with postgres, postgres.cursor() as cur:
+	if schema_current(): return
+	with cursor() as cur:
+		# If several workers start up at once, let one of them make the changes;
+		# the rest wait here, then see its committed version and leave it be.
+		# Nothing, not even the schema, gets touched before the lock is held.
+		cur.execute("select pg_advisory_xact_lock(%s)", (SCHEMA_LOCK,))
+		if _schema_current(cur): return
 		cur.execute("create schema if not exists mustard")
 		cur.execute("""select table_name, column_name
 				from information_schema.columns
@@ -81,38 +371,60 @@ def create_tables():
 				if not need and not xtra: continue # All's well!
 				actions = ["add " + want[c] for c in need] + ["drop column " + c for c in xtra]
 				cur.execute("alter table mustard." + table + " " + ", ".join(actions))
+		# Indexes that back constraints (eg primary keys) are managed by the
+		# tables themselves, so only look at the free-standing ones.
+		cur.execute("""select c.relname from pg_index i
+				join pg_class c on c.oid = i.indexrelid
+				join pg_namespace n on n.oid = c.relnamespace
+				where n.nspname = 'mustard'
+				and not exists (select 1 from pg_constraint where conindid = i.indexrelid)""")
+		have = {row[0] for row in cur}
+		for index, definition in INDEXES.items():
+			if index not in have:
+				cur.execute("create index %s on mustard.%s" % (index, definition))
+		for index in have - INDEXES.keys():
+			cur.execute("drop index mustard." + index)
 		cur.execute("select * from mustard.status")
 		if cur.fetchone() is None:
 			cur.execute("insert into mustard.status default values")
+		cur.execute("update mustard.status set schema_version=%s", (SCHEMA_VERSION,))
 create_tables()
 
+# Sample data for new users. Parsed once, and deep-copied for each use, since
+# restore_from_json is allowed to mutate what it's given.
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.json")) as f:
+	TEMPLATE = json.load(f)
+
+# Users that definitely exist in the database. This is called on every page
+# load, so it needs to be free in the common case.
+known_users = set()
+
 def create_user(twitchid): # Really "ensure_user" as it's quite happy to not-create if exists
 	# TODO: Save the user's OAuth info, incl Twitter.
-	try:
-		with postgres, postgres.cursor() as cur:
-			cur.execute("insert into mustard.users values (%s)", [twitchid])
-		# As a separate transaction (it's okay if this fails), load up
-		# the template data to give some samples.
-		with open("template.json") as f:
-			data = json.load(f)
-		restore_from_json(twitchid, data)
-	except psycopg2.IntegrityError:
-		pass # TODO: Update any extra info eg Twitter OAuth
+	twitchid = int(twitchid)
+	if twitchid in known_users: return
+	with cursor() as cur:
+		cur.execute("insert into mustard.users values (%s) on conflict do nothing returning twitchid", [twitchid])
+		created = cur.fetchone() is not None
+	known_users.add(twitchid)
+	# As a separate transaction (it's okay if this fails), load up
+	# the template data to give some samples.
+	if created: restore_from_json(twitchid, copy.deepcopy(TEMPLATE))
 
 def create_setup(twitchid, *, category, title, tags="", tweet="", ccls="", **extra):
 	"""Create a new 'setup' - a loadable stream config
 
 	Returns the full record just created, including its ID.
 	"""
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+	with cursor(psycopg2.extras.RealDictCursor) as cur:
 		cur.execute("insert into mustard.setups (twitchid, category, title, tags, tweet, ccls) values (%s, %s, %s, %s, %s, %s) returning *",
 			(twitchid, category, title, tags, tweet, ccls))
 		ret = cur.fetchone()
 	return ret
 
 def list_setups(twitchid):
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-		cur.execute("select * from mustard.setups where twitchid=%s order by id", (twitchid,))
+	with cursor(psycopg2.extras.RealDictCursor) as cur:
+		execute_prepared(cur, "list_setups", twitchid)
 		ret = cur.fetchall()
 	return ret
 
@@ -122,18 +434,18 @@ def delete_setup(twitchid, setupid):
 	If the setupid is bad, or if it doesn't belong to the given twitchid,
 	returns 0. There is no permissions-error response - just a 404ish.
 	"""
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		cur.execute("delete from mustard.setups where twitchid=%s and id=%s", (twitchid, setupid))
 		return cur.rowcount
 
 def get_twitter_config(twitchid):
 	"""Return the user's tweet schedule"""
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		cur.execute("select sched_tweet from mustard.users where twitchid=%s", (twitchid,))
 		return cur.fetchone()
 
 def update_twitter_config(twitchid, schedule):
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		cur.execute("update mustard.users set sched_tweet=%s where twitchid=%s",
 			(schedule, twitchid))
 
@@ -143,45 +455,102 @@ def get_checklist(twitchid):
 	Items are separated by \n in a single string.
 	Empty string means no checklist.
 	"""
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		cur.execute("select checklist from mustard.users where twitchid=%s", (twitchid,))
 		return cur.fetchone()[0]
 
 def set_checklist(twitchid, checklist):
 	"""Update the checklist, which must be formatted as lines already"""
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		cur.execute("update mustard.users set checklist=%s where twitchid=%s", (checklist, twitchid,))
 
+def backup_hash(twitchid):
+	"""Hash everything that goes into a user's backup file, without fetching it
+
+	Returns None if the user doesn't exist.
+	"""
+	with cursor() as cur:
+		cur.execute("""select md5(concat_ws(E'\\x1f', u.sched_tweet, u.checklist,
+				coalesce((select json_agg(json_build_array(s.category, s.title, s.tags, s.tweet, s.ccls) order by s.id)
+					from mustard.setups s where s.twitchid = u.twitchid)::text, '[]'),
+				coalesce((select json_agg(json_build_array(t.id, t.title, t.delta, t.maxtime, t.styling) order by t.id)
+					from mustard.timers t where t.twitchid = u.twitchid)::text, '[]')))
+			from mustard.users u where u.twitchid = %s""", (twitchid,))
+		row = cur.fetchone()
+	return row and row[0]
+
 def list_timers(twitchid, *, full=False):
 	"""List the user's timers
 
 	Returns their unique IDs, which are URL-safe strings, and titles, which
 	usually aren't. If full is True, also returns additional fields.
 	"""
-	with postgres, postgres.cursor() as cur:
-		morefields = ", delta, maxtime, styling" if full else ""
-		cur.execute("select id, title" + morefields + " from mustard.timers where twitchid=%s order by id", (twitchid,))
+	with cursor() as cur:
+		execute_prepared(cur, "list_timers_full" if full else "list_timers", twitchid)
 		return cur.fetchall()
 
+def load_timer(id):
+	with cursor(psycopg2.extras.RealDictCursor) as cur:
+		execute_prepared(cur, "get_timer_details", id)
+		return cur.fetchone()
+
+# Timers are read on every countdown load, and change rarely. Every change to
+# one sends a notification on this channel, so that every worker process can
+# discard its cached copy. The expiry is just a backstop.
+TIMER_CHANNEL = "mustard_timers"
+TIMER_FLUSH = "*" # Payload meaning any or all timers may have changed (timer IDs are alphanumeric)
+# Nonexistent timers aren't cached, so requests for junk IDs can't evict real ones
+timer_cache = utils.TTLCache(load_timer, ttl=3600, maxsize=10000, negative_ttl=0)
+
+def timer_notified(payload):
+	if payload == TIMER_FLUSH:
+		# Everything may have been replaced (bulk load), users included
+		known_users.clear()
+		timer_cache.invalidate()
+	else: timer_cache.invalidate(payload)
+listener.listen(TIMER_CHANNEL, timer_notified)
+listener.on_reconnect(lambda: timer_notified(TIMER_FLUSH)) # We may have missed some
+
+def timers_changed(cur, ids):
+	"""Announce changes to the given timers (call within the changing transaction)
+
+	Pass [TIMER_FLUSH] after a bulk change, to have every worker forget them all,
+	along with which users it knows to exist.
+	"""
+	notify(cur, TIMER_CHANNEL, ids)
+
 def get_timer_details(id):
 	"""Get details for a specific timer
 
 	Does not do a permissions check - will return data for ANY user's timers.
 	Perms must be checked externally.
 	"""
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-		cur.execute("select * from mustard.timers where id=%s", (id,))
-		return cur.fetchone()
+	info = timer_cache.get(id)
+	return info and dict(info)
 
 def get_public_timer_details(id):
 	"""Get public details for a specific timer
 
 	Requires no Twitch ID, but is guaranteed to return ONLY public info.
 	"""
-	with postgres, postgres.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
-		cur.execute("select twitchid, title, delta, maxtime, styling from mustard.timers where id=%s", (id,))
-		info = cur.fetchone()
-		return info
+	info = timer_cache.get(id)
+	return info and {key: info[key] for key in ("twitchid", "title", "delta", "maxtime", "styling")}
+
+def load_dashboard(twitchid):
+	"""Load everything the landing page needs from the database
+
+	Returns a dict with sched_tweet, checklist, setups (as per list_setups)
+	and timers (as per list_timers), or None if the user doesn't exist. This
+	is a single query, and thus a single round trip, rather than one each.
+	"""
+	with cursor(psycopg2.extras.RealDictCursor) as cur:
+		cur.execute("""select u.sched_tweet, u.checklist,
+				coalesce((select json_agg(s order by s.id) from mustard.setups s
+					where s.twitchid = u.twitchid), '[]') as setups,
+				coalesce((select json_agg(json_build_array(t.id, t.title) order by t.id) from mustard.timers t
+					where t.twitchid = u.twitchid), '[]') as timers
+			from mustard.users u where u.twitchid = %s""", (twitchid,))
+		return cur.fetchone()
 
 def generate_timer_id():
 	"""Generate an alphanumeric random identifier.
@@ -196,43 +565,130 @@ def generate_timer_id():
 def create_timer(twitchid):
 	"""Create a new timer and return its unique ID"""
 	# TODO: If we happen to collide, rerandomize instead of failing
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		id = generate_timer_id()
 		cur.execute("insert into mustard.timers (id, twitchid) values (%s, %s)", (id, twitchid))
-		return id
+		timers_changed(cur, [id]) # In case anyone had looked it up before it existed
+	timer_cache.invalidate(id)
+	return id
 
 def update_timer_details(twitchid, id, *, title, delta, maxtime, styling):
 	"""Update a timer, but only if it's owned by that twitchid
 
 	Raises ValueError if it found nothing to update
 	"""
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		cur.execute("update mustard.timers set title=%s, delta=%s, maxtime=%s, styling=%s where id=%s and twitchid=%s",
 			(title, delta, maxtime, styling, id, twitchid))
 		if not cur.rowcount: raise ValueError("Timer not found, or not owned by that user")
+		timers_changed(cur, [id])
+	# Other workers will hear about it shortly; this one needs to know right now.
+	timer_cache.invalidate(id)
 
 def delete_timer(twitchid, id):
 	"""Delete a timer, but only if it's owned by that twitchid
 
 	Raises ValueError if it found nothing to delete
 	"""
-	with postgres, postgres.cursor() as cur:
+	with cursor() as cur:
 		cur.execute("delete from mustard.timers where id=%s and twitchid=%s",
 			(id, twitchid))
 		if not cur.rowcount: raise ValueError("Timer not found, or not owned by that user")
+		timers_changed(cur, [id])
+	timer_cache.invalidate(id)
+
+def get_game_id(name):
+	"""Look up a category ID by its exact name; returns None if not known"""
+	with cursor() as cur:
+		cur.execute("select id from mustard.games where name=%s", (name,))
+		row = cur.fetchone()
+		return row and row[0]
+
+def save_games(games):
+	"""Remember the IDs (and box art) of any number of categories
+
+	games is an iterable of (name, id, boxart) tuples.
+	"""
+	games = {g[0]: g for g in games} # Dedup by name, since one statement can't upsert a row twice
+	if not games: return
+	with cursor() as cur:
+		psycopg2.extras.execute_values(cur, """insert into mustard.games (name, id, boxart) values %s
+			on conflict (name) do update set id=excluded.id, boxart=excluded.boxart""",
+			list(games.values()))
+
+def schedule_tweet(due, cred, tweet):
+	"""Save a tweet to be sent at the given time_t; returns its ID"""
+	with cursor() as cur:
+		cur.execute("insert into mustard.scheduled_jobs (due, token, secret, tweet) values (to_timestamp(%s), %s, %s, %s) returning id",
+			(due, cred[0], cred[1], psycopg2.extras.Json(tweet)))
+		return cur.fetchone()[0]
+
+def list_scheduled_tweets(cred):
+	"""List the tweets waiting to be sent with the given credentials
+
+	Returns (time_t, id, tweet) tuples in the order they're due.
+	"""
+	with cursor() as cur:
+		cur.execute("""select extract(epoch from due)::integer, id, tweet from mustard.scheduled_jobs
+			where token=%s and secret=%s order by due, id""", cred)
+		return cur.fetchall()
+
+def cancel_scheduled_tweet(cred, id):
+	"""Cancel a scheduled tweet, if it exists and has those credentials
+
+	Returns True if it was cancelled. If the tweet is being sent right now,
+	this waits until that's done, and then finds nothing to cancel.
+	"""
+	with cursor() as cur:
+		cur.execute("delete from mustard.scheduled_jobs where id=%s and token=%s and secret=%s", (id, *cred))
+		return cur.rowcount > 0
+
+def claim_scheduled_tweets(*, id=None, limit=10):
+	"""Claim scheduled tweets for sending, removing them from the queue
+
+	If id is given, claims just that tweet, regardless of whether it's due;
+	otherwise, claims up to limit tweets that are now due. Rows are locked
+	with SKIP LOCKED and deleted in one short transaction, which is committed
+	before this returns, so any number of workers can do this at once and
+	each tweet is handed out exactly once. Sending them is up to the caller,
+	outside of any transaction; if that fails, they are not retried.
+	Returns a list of (id, due, (token, secret), tweet), with due as a time_t.
+	"""
+	with cursor() as cur:
+		if id is not None:
+			cur.execute("""delete from mustard.scheduled_jobs where id in (
+					select id from mustard.scheduled_jobs where id=%s for update skip locked)
+				returning id, extract(epoch from due)::float8, token, secret, tweet""", (id,))
+		else:
+			cur.execute("""delete from mustard.scheduled_jobs where id in (
+					select id from mustard.scheduled_jobs where due <= now()
+					order by due limit %s for update skip locked)
+				returning id, extract(epoch from due)::float8, token, secret, tweet""", (limit,))
+		return [(id, due, (token, secret), tweet) for id, due, token, secret, tweet in cur]
 
 class ValidationError(Exception): pass
 class Restorer(contextlib.ExitStack):
-	"""Context manager for a one-transaction full restoration action"""
+	"""Context manager for a one-transaction full restoration action
+
+	The restore_* methods validate and record what is to be done, building up
+	the summary as they go; nothing is written until apply(), which does each
+	section as a single bulk statement.
+	"""
 	def __init__(self, twitchid):
 		super().__init__()
 		self.twitchid = twitchid
 		self.summary = ""
+		self.wipe = False
+		self.setups = [] # Rows to insert
+		self.user = {} # Column: new value, for mustard.users
+		self.timer_updates = [] # (id, title, delta, maxtime, styling) with None meaning unchanged
+		self.timer_inserts = [] # Full rows, with DEFAULT for anything unspecified
+		self.timer_deletes = []
+		self.changed_timers = []
 
 	def __enter__(self):
 		super().__enter__()
-		self.enter_context(postgres)
-		self.cur = self.enter_context(postgres.cursor())
+		self.cur = self.enter_context(cursor())
 		# List all pre-existing timers so untouched ones can get wiped
 		self.cur.execute("select id from mustard.timers where twitchid=%s", (self.twitchid,))
 		self.timers = {tm[0] for tm in self.cur}
@@ -260,32 +716,26 @@ class Restorer(contextlib.ExitStack):
 		if "self" in data: raise ValidationError("Invalid key in data") # I doubt anyone will see this, but keep us safe
 
 	def wipe_setups(self):
-		self.cur.execute("delete from mustard.setups where twitchid = %s", (self.twitchid,))
+		self.wipe = True
 
 	def restore_setup(self, *, category=None, title=None, tags="", tweet="", ccls=""):
 		if not category or not title: raise ValidationError("Setups: Category and title are required")
-		self.cur.execute("insert into mustard.setups (twitchid, category, title, tags, tweet, ccls) values (%s, %s, %s, %s, %s, %s) returning id",
-			(self.twitchid, category, title, tags, tweet, ccls))
+		self.setups.append((self.twitchid, category, title, tags, tweet, ccls))
 		self.summary += "Restored %r setup\n" % category
 
 	def restore_twitter_config(self, tweet):
-		self.cur.execute("update mustard.users set sched_tweet=%s where twitchid=%s",
-			(tweet, self.twitchid))
+		self.user["sched_tweet"] = tweet
 		self.summary += "Restored default tweet schedule\n"
 
 	def restore_checklist(self, checklist):
-		self.cur.execute("update mustard.users set checklist=%s where twitchid=%s", (checklist, self.twitchid,))
+		self.user["checklist"] = checklist
 		self.summary += "Restored personal checklist\n"
 
 	def restore_timer(self, *, id, title=None, delta=None, maxtime=None, styling=None):
 		if id in self.timers:
 			# It existed already. Update it.
 			self.timers.remove(id)
-			self.cur.execute("""update mustard.timers set
-						title=coalesce(%s, title), delta=coalesce(%s, delta),
-						maxtime=coalesce(%s, maxtime), styling=coalesce(%s, styling)
-					where id=%s""",
-				(title, delta, maxtime, styling, id))
+			self.timer_updates.append((id, title, delta, maxtime, styling))
 			self.summary += "Restored details for timer %s\n" % id
 		else:
 			# It didn't exist, or you tried to restore two timers with the same ID.
@@ -294,16 +744,42 @@ class Restorer(contextlib.ExitStack):
 			# will get destroyed. So repeatedly restoring a file with the wrong ID
 			# in it will churn your IDs, but nothing else (you won't accrue timers).
 			id = generate_timer_id(); twitchid = self.twitchid
-			args = [DEFAULT if x is None else x for x in (id, twitchid, title, delta, maxtime, styling)]
-			self.cur.execute("insert into mustard.timers (id, twitchid, title, delta, maxtime, styling) values (%s, %s, %s, %s, %s, %s)", args)
+			self.timer_inserts.append([DEFAULT if x is None else x for x in (id, twitchid, title, delta, maxtime, styling)])
 			self.summary += "Recreated timer %s\n" % id
 
 	def wipe_untouched_timers(self):
 		# Delete any timer that wasn't restored
 		for id in self.timers:
-			self.cur.execute("delete from mustard.timers where id=%s", (id,))
+			self.timer_deletes.append(id)
 			self.summary += "Deleted timer %s\n" % id
 
+	def apply(self):
+		"""Write everything recorded so far, one statement per section"""
+		if self.wipe:
+			self.cur.execute("delete from mustard.setups where twitchid = %s", (self.twitchid,))
+		if self.setups:
+			psycopg2.extras.execute_values(self.cur, "insert into mustard.setups (twitchid, category, title, tags, tweet, ccls) values %s",
+				self.setups, page_size=len(self.setups))
+		if self.user:
+			# Column names come from our own code, never from the backup file
+			self.cur.execute("update mustard.users set " + ", ".join(c + "=%s" for c in self.user) + " where twitchid=%s",
+				(*self.user.values(), self.twitchid))
+		if self.timer_updates:
+			psycopg2.extras.execute_values(self.cur, """update mustard.timers t set
+						title=coalesce(v.title, t.title), delta=coalesce(v.delta, t.delta),
+						maxtime=coalesce(v.maxtime, t.maxtime), styling=coalesce(v.styling, t.styling)
+					from (values %s) as v (id, title, delta, maxtime, styling)
+					where t.id = v.id""",
+				self.timer_updates, template="(%s, %s::text, %s::integer, %s::integer, %s::text)",
+				page_size=len(self.timer_updates))
+		if self.timer_inserts:
+			psycopg2.extras.execute_values(self.cur, "insert into mustard.timers (id, twitchid, title, delta, maxtime, styling) values %s",
+				self.timer_inserts, page_size=len(self.timer_inserts))
+		if self.timer_deletes:
+			self.cur.execute("delete from mustard.timers where id = any(%s)", (self.timer_deletes,))
+		self.changed_timers = [t[0] for t in self.timer_updates] + [t[0] for t in self.timer_inserts] + self.timer_deletes
+		if self.changed_timers: timers_changed(self.cur, self.changed_timers)
+
 def restore_from_json(twitchid, data):
 	# Open a single database transaction and do all the work.
 	with Restorer(twitchid) as r:
@@ -341,4 +817,8 @@ def restore_from_json(twitchid, data):
 				r.check_dict(timer)
 				r.restore_timer(**timer)
 			r.wipe_untouched_timers()
+		# Everything's valid. Now actually do it.
+		r.apply()
+	if not r.failed:
+		for id in r.changed_timers: timer_cache.invalidate(id)
 	return r
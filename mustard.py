@@ -14,9 +14,11 @@ from pprint import pprint
 # patching happen automatically, it happens too late, and we get
 # RecursionErrors and such. There's a helpful warning on startup.
 from gevent import monkey; monkey.patch_all(subprocess=True)
-from flask import Flask, request, redirect, session, url_for, g, render_template, jsonify, Response, Markup
+import gevent
+import gevent.queue
+from flask import Flask, request, redirect, session, url_for, g, render_template, jsonify, Response, Markup, copy_current_request_context
 from flask_sockets import Sockets
-from authlib.integrations.requests_client import OAuth1Session, OAuth2Session
+from authlib.integrations.requests_client import OAuth1Auth, OAuth1Session, OAuth2Session
 import requests
 
 # Flask_Sockets 0.2.1 with Werkzeug 2.0.0+ breaks on all websocket connections due to
@@ -77,36 +79,79 @@ all_ccls = [{'id': 'DrugsIntoxication', 'description': 'Excessive tobacco glorif
 # If it's set to None, we'll do the fetch.
 # all_ccls = None
 
+class AppToken:
+	"""Process-wide cache of the Twitch app access token (client credentials)
+
+	The token is reused until shortly before it expires. Refreshing happens
+	under a lock, so a burst of concurrent requests results in only one call
+	to the token endpoint; everyone else waits for that one and shares it.
+	"""
+	def __init__(self):
+		self.token = None
+		self.expires = 0
+		self.lock = threading.Lock()
+
+	def get(self, *, stale=None):
+		"""Return a current app token, minting a new one if needed
+
+		If stale is provided, it is a token that Twitch has just rejected, and
+		will not be returned again. (If another caller has already replaced it,
+		the replacement is returned without a second mint.)
+		"""
+		if self.token and self.token != stale and self.expires > time.time(): return self.token
+		with self.lock:
+			# Check again - someone else may have refreshed it while we waited
+			if self.token and self.token != stale and self.expires > time.time(): return self.token
+			r = utils.http.post("https://id.twitch.tv/oauth2/token", data={
+				"grant_type": "client_credentials",
+				"client_id": config.CLIENT_ID, "client_secret": config.CLIENT_SECRET,
+			})
+			r.raise_for_status()
+			data = r.json()
+			self.token = data["access_token"]
+			# Give ourselves a couple of minutes' grace before the real expiry
+			self.expires = time.time() + data["expires_in"] - 120
+			return self.token
+app_token = AppToken()
+
+# Twitch rate-limits each token separately (the app token is one bucket, and each
+# user's bearer token is another), so buckets are keyed by Authorization header.
+twitch_ratelimit = utils.RateLimiter()
+
 def query(endpoint, *, token, method="GET", params=None, data=None, auto_refresh=True):
 	# If this is called outside of a Flask request context, be sure to provide
 	# the auth token, and set auto_refresh to False.
-	# TODO: Cache the app token, then use that for any non-authenticated calls,
-	# which will mean it's just "auth" or "no auth".
 	if token is None:
 		auth = None
 	elif token == "bearer":
 		auth = "Bearer " + session["twitch_token"]
 	elif token == "app":
-		r = requests.post("https://id.twitch.tv/oauth2/token", data={
-			"grant_type": "client_credentials",
-			"client_id": config.CLIENT_ID, "client_secret": config.CLIENT_SECRET,
-		})
-		r.raise_for_status()
-		data = r.json()
-		auth = "Bearer " + data["access_token"]
-		# TODO: Save the token so long as it's valid
-		# expires = int(time.time()) + data["expires_in"] - 120
+		auth = "Bearer " + app_token.get()
 	else:
 		raise Exception("Shouldn't happen - bad token type code")
 
 	if not endpoint.startswith("helix/"): endpoint = "helix/" + endpoint
-	r = requests.request(method, "https://api.twitch.tv/" + endpoint,
-		params=params, json=data, headers={
-		"Client-ID": config.CLIENT_ID,
-		"Authorization": auth,
-	})
-	if auto_refresh and r.status_code == 401 and r.json()["message"].lower() == "invalid oauth token":
-		r = requests.post("https://id.twitch.tv/oauth2/token", data={
+	def send(auth):
+		attempts = 3
+		for attempt in range(attempts):
+			twitch_ratelimit.wait(auth)
+			r = utils.http.request(method, "https://api.twitch.tv/" + endpoint,
+				params=params, json=data, headers={
+				"Client-ID": config.CLIENT_ID,
+				"Authorization": auth,
+			})
+			twitch_ratelimit.update(auth, r.headers)
+			if r.status_code != 429: break
+			# Wait out the limit before retrying, but not after giving up
+			if attempt < attempts - 1: time.sleep(twitch_ratelimit.retry_delay(auth))
+		return r
+	r = send(auth)
+	if token == "app" and r.status_code == 401:
+		# The app token has been revoked or expired early. Mint a new one and
+		# retry, once. This doesn't need the session, so auto_refresh is moot.
+		r = send("Bearer " + app_token.get(stale=auth[len("Bearer "):]))
+	elif auto_refresh and r.status_code == 401 and r.json()["message"].lower() == "invalid oauth token":
+		r = utils.http.post("https://id.twitch.tv/oauth2/token", data={
 			"grant_type": "refresh_token",
 			"refresh_token": session["twitch_refresh_token"],
 			"client_id": config.CLIENT_ID, "client_secret": config.CLIENT_SECRET,
@@ -187,10 +232,9 @@ def wants_channelid(f):
 	return handler
 
 def list_scheduled_tweets(token, secret):
-	cred = (token, secret)
-	return [(format_time(tm, None), id, args[1]) for tm, id, args in scheduler.search(send_tweet) if args[0] == cred]
+	return [(format_time(tm, None), id, tweet) for tm, id, tweet in database.list_scheduled_tweets((token, secret))]
 
-def get_channel_setup(channelid):
+def fetch_channel_setup(channelid):
 	channel = query("helix/channels?broadcaster_id=" + channelid, token="bearer")["data"][0]
 	# For compatibility and convenience, provide _id as an alias for broadcaster_id.
 	channel["_id"] = channel["broadcaster_id"]
@@ -200,6 +244,56 @@ def get_channel_setup(channelid):
 	channel["ccls"] = ", ".join(channel["content_classification_labels"])
 	return channel
 
+# The landing page and the undo info for /api/update both want the channel's
+# current status. Keep it briefly, and have do_update() write changes through.
+# No stale-while-revalidate here, as fetching needs the user's own token.
+channel_cache = utils.TTLCache(fetch_channel_setup, ttl=60, maxsize=10000)
+
+def get_channel_setup(channelid):
+	return dict(channel_cache.get(str(channelid))) # Copy, so callers can't mutate the cache
+
+def fetch_user_ids(logins):
+	"""Look up the user IDs for up to 100 logins in one Helix call"""
+	try:
+		users = query("helix/users", token="app", params={"login": logins})["data"]
+	except requests.exceptions.HTTPError as e:
+		# A malformed login gets the entire call rejected, not just omitted, so
+		# don't let it fail everyone else's lookups: try them one at a time.
+		if e.response is None or e.response.status_code != 400: raise
+		if len(logins) == 1: return {} # That one's no good, so it's unknown
+		ret = {}
+		for login in logins: ret.update(fetch_user_ids([login]))
+		return ret
+	# Bad logins are simply omitted from the response.
+	return {user["login"]: user["id"] for user in users}
+
+# Logins rarely change hands, so keep them for an hour, and batch up concurrent
+# lookups of different names into a single call. Unknown names cache as None.
+# Note that nothing reaches this at present: the only caller is mainpage() for
+# /editor/<name>, and that route is currently served by no_editors_allowed().
+# It's kept ready for if editor access returns.
+login_batcher = utils.Batcher(fetch_user_ids, maxbatch=100)
+login_cache = utils.TTLCache(login_batcher.get, ttl=3600, maxsize=10000)
+
+# Upper bounds on how long a page will wait for each of its dependencies
+TWITCH_TIMEOUT = 10
+DATABASE_TIMEOUT = 5
+
+def gather(jobs):
+	"""Wait for a set of concurrently-running greenlets
+
+	jobs maps names to (greenlet, timeout) pairs; returns a dict mapping the
+	same names to the greenlets' results. Each timeout is measured from when
+	gather() was called, so the total wait is bounded by the longest of them.
+	If anything fails or times out, the exception (possibly gevent.Timeout)
+	propagates. Anything still running is left to finish on its own rather
+	than killed, as it may be a shared cache fetch that other requests are
+	waiting on too; we just stop waiting for it.
+	"""
+	start = time.monotonic()
+	return {name: job.get(timeout=max(timeout - (time.monotonic() - start), 0))
+		for name, (job, timeout) in jobs.items()}
+
 @app.route("/editor/<channelid>")
 def no_editors_allowed(channelid):
 	return """Channel editors are not able to change channel settings using third-party tools. If this shutdown has affected
@@ -221,14 +315,28 @@ def mainpage(channelid=None):
 		# If you go to /editor/somename, redirect to /editor/equivalent-id
 		# Bookmarking the version with the ID will be slightly faster, but
 		# streamers will usually want to share the version with the name.
-		users = query("helix/users", token="app", params={"login": channelid})["data"]
-		# users is either an empty list (bad login) or a list of one.
-		if not users: return redirect("/")
-		return redirect("/editor/" + users[0]["id"])
+		id = login_cache.get(channelid.lower())
+		if not id: return redirect("/")
+		return redirect("/editor/" + id)
 	if not may_edit_channel(user["_id"], channelid): return redirect(url_for("mainpage"))
+	# The Twitch lookup is independent of the database, so get it started first.
+	channel = gevent.spawn(copy_current_request_context(get_channel_setup), channelid)
 	database.create_user(channelid) # Just in case, make sure the database has the basic structure
-	channel = get_channel_setup(channelid)
-	[sched_tweet] = database.get_twitter_config(channelid)
+	try:
+		info = gather({
+			"channel": (channel, TWITCH_TIMEOUT),
+			"dashboard": (gevent.spawn(database.load_dashboard, channelid), DATABASE_TIMEOUT),
+		})
+	except gevent.Timeout:
+		return "Timed out loading your channel details, please try again shortly", 504
+	dashboard = info["dashboard"]
+	if dashboard is None:
+		# The user was removed from under us (eg by a bulk load) after this
+		# worker had seen them. Recreate them and try once more.
+		database.known_users.discard(int(channelid))
+		database.create_user(channelid)
+		dashboard = database.load_dashboard(channelid)
+		if dashboard is None: return "Unable to load your channel details, please try again shortly", 503
 	if "twitter_oauth" in session:
 		auth = session["twitter_oauth"]
 		username = auth["screen_name"]
@@ -241,17 +349,29 @@ def mainpage(channelid=None):
 	session["last_error_message"] = ""
 	return render_template("index.html",
 		twitter=twitter, username=user["display_name"],
-		channel=channel, channelid=channelid, error=error,
-		setups=database.list_setups(channelid),
-		checklist=database.get_checklist(channelid),
-		timers=database.list_timers(channelid),
-		sched_tweet=sched_tweet, tweets=tweets,
+		channel=info["channel"], channelid=channelid, error=error,
+		setups=dashboard["setups"], checklist=dashboard["checklist"], timers=dashboard["timers"],
+		sched_tweet=dashboard["sched_tweet"], tweets=tweets,
 		all_ccls=all_ccls,
 	)
 
-def find_game_id(game_name, token="bearer"): # pass token="app" if no login - slower b/c we don't cache app tokens (yet)
+# Category name to ID. Backed by the mustard.games table, so it survives restarts.
+game_ids = {}
+def remember_games(games):
+	"""Record (name, id, boxart) tuples locally and in the database"""
+	games = list(games)
+	for name, id, boxart in games: game_ids[name] = id
+	database.save_games(games)
+
+def find_game_id(game_name, token="bearer"): # pass token="app" if no login
+	if game_name in game_ids: return game_ids[game_name]
+	id = database.get_game_id(game_name)
+	if id:
+		game_ids[game_name] = id
+		return id
 	resp = query("helix/games", token=token, params={"name": game_name})["data"]
 	if not resp: return None
+	remember_games((game["name"], game["id"], game["box_art_url"]) for game in resp)
 	return resp[0]["id"]
 
 def do_update(channelid, info):
@@ -284,7 +404,18 @@ def do_update(channelid, info):
 				for ccl in all_ccls
 			],
 		}, token="bearer")
-	except requests.exceptions.HTTPError as e:
+		channel = channel_cache.peek(str(channelid))
+		if channel:
+			# We know exactly what we just told Twitch, so update the cached
+			# copy rather than discarding it. Note that MatureGame is set by the
+			# category, so it can only be retained if the category is unchanged.
+			mature = channel["game_id"] == gameid and "MatureGame" in channel["content_classification_labels"]
+			labels = ["MatureGame"] * mature + [ccl["id"] for ccl in all_ccls if ccl["id"] in ccls]
+			channel = dict(channel, game_id=gameid, game_name=info.get("category", channel["game_name"]),
+				title=info["title"], tags=", ".join(tags), content_classification_labels=labels, ccls=", ".join(labels))
+			channel["game"] = channel["game_name"]; channel["status"] = channel["title"]
+			channel_cache.set(str(channelid), channel)
+	except requests.exceptions.RequestException as e: # Includes timeouts as well as HTTP errors
 		try: return "Error updating stream status: " + e.message
 		except AttributeError:
 			print(e)
@@ -328,34 +459,56 @@ def update_twitter_cfg(channelid):
 	return jsonify({"ok": True, "success": "Twitter defaults updated",
 		"new_sched": sched})
 
-def get_schedule(channelid, delta=0):
+def fetch_schedule_segments(channelid):
+	"""Fetch a channel's upcoming, non-cancelled schedule segments from Twitch
+
+	Returns (start time, segment) pairs. This is independent of any timer
+	delta, so it looks a little further ahead than the one week that
+	get_schedule() will ultimately return, to allow for deltas of up to a day.
+	"""
 	cursor = ""
-	schedule = []
-	now = datetime.datetime.now().astimezone(datetime.timezone.utc) - datetime.timedelta(seconds=delta)
-	nextweek = now + datetime.timedelta(days=7)
+	segments = []
+	horizon = datetime.datetime.now().astimezone(datetime.timezone.utc) + datetime.timedelta(days=8)
 	while cursor is not None:
 		try:
 			data = query("helix/schedule", token="app", params={"broadcaster_id": channelid, "after": cursor}, auto_refresh=False)
 		except requests.exceptions.HTTPError:
 			data = { } # TODO: Only do this if we get specifically a 404
 		if not data.get("data"): break
-		segments = data["data"].get("segments")
-		if not segments: break # Might not be an error - might just be that there aren't any
-		for s in segments:
+		page = data["data"].get("segments")
+		if not page: break # Might not be an error - might just be that there aren't any
+		for s in page:
 			tm = datetime.datetime.strptime(s["start_time"], "%Y-%m-%dT%H:%M:%S%z")
-			if tm > nextweek: return schedule
+			if tm > horizon: return segments
 			if s["canceled_until"]: continue
-			if tm < now: continue # Event started in the past. Presumably it ends in the future.
-			schedule.append({"title": s["title"], "category": s.get("category") or {},
-				"start_time": s["start_time"], "unixtime": int(tm.timestamp()) + delta})
+			segments.append((tm, s))
 		cursor = data["pagination"].get("cursor")
+	return segments
+
+# Countdowns for the same channel tend to all load at once (eg when OBS reloads
+# its scenes), so share one Twitch lookup between them and keep it for a minute.
+# Up to five minutes past that, serve the old one while fetching a new one.
+schedule_cache = utils.TTLCache(fetch_schedule_segments, ttl=60, stale=300, maxsize=10000)
+
+def get_schedule(channelid, delta=0, *, fresh=False):
+	# Pass fresh=True when acting on the result, not just displaying it
+	if fresh: schedule_cache.invalidate(str(channelid))
+	schedule = []
+	now = datetime.datetime.now().astimezone(datetime.timezone.utc) - datetime.timedelta(seconds=delta)
+	nextweek = now + datetime.timedelta(days=7)
+	for tm, s in schedule_cache.get(str(channelid)):
+		if tm > nextweek: break
+		if tm < now: continue # Event started in the past. Presumably it ends in the future.
+		schedule.append({"title": s["title"], "category": s.get("category") or {},
+			"start_time": s["start_time"], "unixtime": int(tm.timestamp()) + delta})
 	return schedule
 
 @app.route("/api/twitch_schedule")
 @wants_channelid
 def fetch_schedule(channelid):
 	if "twitch_user" not in session: return jsonify({"ok": False, "error": "Unauthorized"})
-	return jsonify({"ok": True, "schedule": get_schedule(channelid)});
+	# The Refresh button asks for a guaranteed-fresh lookup, eg after editing the schedule on Twitch
+	return jsonify({"ok": True, "schedule": get_schedule(channelid, fresh=bool(request.args.get("refresh")))});
 
 @app.route("/checklist", methods=["POST"])
 @wants_channelid
@@ -371,7 +524,8 @@ def do_tweet(channelid, tweet, schedule, auth):
 	if schedule == "now":
 		info = send_tweet((auth["oauth_token"], auth["oauth_token_secret"]), tweet)
 		return info.get("error", "")
-	events = get_schedule(channelid, int(schedule))
+	# The tweet goes out at the time Twitch has now, not whatever we last cached
+	events = get_schedule(channelid, int(schedule), fresh=True)
 	if not events: return "Can't schedule tweets without a schedule!"
 	target = events[0]["unixtime"]
 	if target - time.time() > 1800:
@@ -381,18 +535,75 @@ def do_tweet(channelid, tweet, schedule, auth):
 		# that this tweet will indeed happen prior to dyno sleep.
 		# (Dyno sleep? Not the "Slumbering Dragon" from M13 methinks.)
 		return "Refusing to schedule a tweet more than half an hour in advance"
-	# TODO: Retain the tweet and token in Postgres in case the server restarts
-	# We'll assume the token won't need changing - but we assume that already.
-	# Keep the one-hour limit (give or take) to minimize the likelihood of the
-	# token expiring. Don't fret the weirdnesses; if stuff breaks, be sure the
-	# tweets get retained, and then let Twitter worry about deduplication - it
-	# apparently isn't possible to post the same tweet twice. (Whodathunk?) So
-	# if tweeting fails, check to see if it was "duplicate status", and if so,
-	# remove the tweet from the database. (Otherwise, error means "try again",
-	# unless we just want to schedule tweets as fire-and-forget.)
-	scheduler.put(target, send_tweet, (auth["oauth_token"], auth["oauth_token_secret"]), tweet)
+	# The tweet and token are retained in Postgres in case the server restarts;
+	# any worker can then pick it up (see tweet_dispatcher). We'll assume the
+	# token won't need changing - but we assume that already. Keep the limit
+	# to minimize the likelihood of the token expiring. Once a tweet has been
+	# attempted, it's gone from the database, whether Twitter accepted it or
+	# not; whichever worker sent it remembers how it went (see tweet_outcomes).
+	id = database.schedule_tweet(target, (auth["oauth_token"], auth["oauth_token_secret"]), tweet)
+	# Wake up right on time to send it. If this worker goes away in the
+	# meantime, another worker's periodic sweep will take care of it.
+	scheduler.put(target, dispatch_scheduled_tweet, id)
 	return None
 
+# Once claimed, a tweet is gone from the database, so the outcome of the most
+# recent ones is kept here, by tweet ID, for /api/tweet/<id> to report. This
+# is the only record; the scheduler itself doesn't keep what its jobs return.
+TWEET_OUTCOMES_KEPT = 1000
+tweet_outcomes = collections.OrderedDict() # id: {"cred", "finished", "result"/"error"}
+tweet_outcomes_lock = threading.Lock()
+
+def record_tweet_outcome(id, cred, **outcome):
+	outcome["cred"] = cred; outcome["finished"] = time.time()
+	with tweet_outcomes_lock:
+		tweet_outcomes[id] = outcome
+		while len(tweet_outcomes) > TWEET_OUTCOMES_KEPT:
+			tweet_outcomes.popitem(last=False)
+
+def send_scheduled_tweet(id, cred, tweet):
+	"""Send a tweet that has already been claimed from the database"""
+	try:
+		info = send_tweet(cred, tweet)
+	except Exception as e:
+		# Don't let one failure stop the others claimed with it from being sent
+		print("Scheduled tweet %d failed: %r" % (id, e))
+		info = {"error": "Unable to send tweet: %r" % e}
+	except BaseException as e:
+		# The scheduler's timeout; note it, then let it unwind the job as usual
+		record_tweet_outcome(id, cred, error="Timed out sending tweet: %r" % e)
+		raise
+	if "error" in info:
+		print("Scheduled tweet %d failed: %s" % (id, info["error"]))
+		record_tweet_outcome(id, cred, error=info["error"])
+	else: record_tweet_outcome(id, cred, result=info)
+	return info
+
+def dispatch_scheduled_tweet(id):
+	# If it isn't there, it was cancelled, or another worker's sweep got it first
+	for id, due, cred, tweet in database.claim_scheduled_tweets(id=id):
+		send_scheduled_tweet(id, cred, tweet)
+
+TWEET_SWEEP_INTERVAL = 30
+def tweet_dispatcher():
+	"""Periodically send any scheduled tweets that are overdue
+
+	Normally the worker that scheduled a tweet sends it on time, but if that
+	worker has since restarted, someone else needs to.
+	"""
+	while True:
+		time.sleep(TWEET_SWEEP_INTERVAL)
+		try:
+			while True:
+				claimed = database.claim_scheduled_tweets()
+				if not claimed: break
+				# Send them the same way as on-time tweets, concurrently and with a timeout.
+				# They're scheduled for when they were due, which has already passed, so
+				# they go out at once and the scheduler sees how late they really were.
+				for id, due, cred, tweet in claimed: scheduler.put(due, send_scheduled_tweet, id, cred, tweet)
+		except Exception as e:
+			print("Error sending scheduled tweets: %r" % e)
+
 def send_tweet(auth, tweet, in_reply_to=None):
 	"""Actually send a tweet"""
 	if isinstance(tweet, list):
@@ -405,9 +616,11 @@ def send_tweet(auth, tweet, in_reply_to=None):
 			if not ret: ret = info # Return the info for the *first* tweet sent
 			prev = info["tweet_id"]
 		return ret or {"error": "Can't send a thread of nothing but empty tweets"}
-	twitter = OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET, auth[0], auth[1])
-	resp = twitter.post("https://api.twitter.com/1.1/statuses/update.json",
-		data={"status": tweet, "in_reply_to_status_id": in_reply_to})
+	# Sign with the user's credentials but send over the shared pooled session,
+	# so the parts of a thread (and consecutive tweets) reuse one connection.
+	resp = utils.http.post("https://api.twitter.com/1.1/statuses/update.json",
+		data={"status": tweet, "in_reply_to_status_id": in_reply_to},
+		auth=OAuth1Auth(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET, auth[0], auth[1]))
 	if resp.status_code != 200:
 		print("Unknown response from Twitter")
 		print(resp.status_code)
@@ -449,10 +662,7 @@ def api_tweet(channelid):
 def cancel_tweet(id):
 	auth = session["twitter_oauth"]
 	cred = (auth["oauth_token"], auth["oauth_token_secret"])
-	for tm, i, args in scheduler.search(send_tweet):
-		if args[0] == cred and id == i:
-			scheduler.remove(id)
-			return redirect(url_for("mainpage"))
+	if database.cancel_scheduled_tweet(cred, id): return redirect(url_for("mainpage"))
 	return "No such tweet to remove (might have already been sent)"
 
 @app.route("/api/tweet/<int:id>", methods=["DELETE"])
@@ -460,18 +670,27 @@ def api_cancel_tweet(id):
 	auth = session["twitter_oauth"]
 	cred = (auth["oauth_token"], auth["oauth_token_secret"])
 	ret = {"ok": False, "error": "No such tweet to remove (might have already been sent)"}
-	for tm, i, args in scheduler.search(send_tweet):
-		if args[0] == cred and id == i:
-			scheduler.remove(id)
-			ret = {"ok": True, "success": "Tweet cancelled"}
-			break
+	if database.cancel_scheduled_tweet(cred, id):
+		ret = {"ok": True, "success": "Tweet cancelled"}
 	ret["new_tweets"] = get_user_tweets()
 	return jsonify(ret)
 
+@app.route("/api/tweet/<int:id>")
+def api_tweet_status(id):
+	auth = session["twitter_oauth"]
+	cred = (auth["oauth_token"], auth["oauth_token_secret"])
+	with tweet_outcomes_lock: outcome = tweet_outcomes.get(id)
+	if outcome and outcome["cred"] == cred:
+		if "error" in outcome: return jsonify({"ok": False, "sent": False, "error": outcome["error"]})
+		return jsonify({"ok": True, "sent": True, **outcome["result"]})
+	if any(t[1] == id for t in get_user_tweets()): return jsonify({"ok": True, "sent": False})
+	# Sent by another worker, or long enough ago to have been forgotten
+	return jsonify({"ok": False, "error": "No record of that tweet on this server"})
+
 @app.route("/login")
 def login():
-	twitch = OAuth2Session(config.CLIENT_ID, config.CLIENT_SECRET,
-		scope=REQUIRED_SCOPES)
+	twitch = utils.pooled(OAuth2Session(config.CLIENT_ID, config.CLIENT_SECRET,
+		scope=REQUIRED_SCOPES))
 	uri, state = twitch.create_authorization_url("https://id.twitch.tv/oauth2/authorize",
 		redirect_uri=os.environ.get("OVERRIDE_REDIRECT_URI") or url_for("authorized", _external=True))
 	session["login_state"] = state
@@ -483,8 +702,8 @@ def authorized():
 		# User cancelled the auth flow - discard auth (most likely there won't be any)
 		session.pop("twitch_token", None)
 		return redirect(url_for("mainpage"))
-	twitch = OAuth2Session(config.CLIENT_ID, config.CLIENT_SECRET,
-		state=session["login_state"])
+	twitch = utils.pooled(OAuth2Session(config.CLIENT_ID, config.CLIENT_SECRET,
+		state=session["login_state"]))
 	resp = twitch.fetch_access_token("https://id.twitch.tv/oauth2/token",
 		code=request.args["code"],
 		# For some bizarre reason, we need to pass this information along.
@@ -508,8 +727,8 @@ def authorized():
 
 @app.route("/login-twitter")
 def login_twitter():
-	twitter = OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET,
-		redirect_uri=url_for("authorized_twitter", _external=True))
+	twitter = utils.pooled(OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET,
+		redirect_uri=url_for("authorized_twitter", _external=True)))
 	session["twitter_state"] = twitter.fetch_request_token("https://api.twitter.com/oauth/request_token")
 	return redirect(twitter.create_authorization_url("https://api.twitter.com/oauth/authenticate"))
 
@@ -520,8 +739,8 @@ def authorized_twitter():
 		session.pop("twitter_oauth", None)
 		return redirect(url_for("mainpage"))
 	req_token = session["twitter_state"]
-	twitter = OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET,
-		req_token["oauth_token"], req_token["oauth_token_secret"])
+	twitter = utils.pooled(OAuth1Session(config.TWITTER_CLIENT_ID, config.TWITTER_CLIENT_SECRET,
+		req_token["oauth_token"], req_token["oauth_token_secret"]))
 	resp = twitter.fetch_access_token("https://api.twitter.com/oauth/access_token", request.args["oauth_verifier"])
 	session["twitter_oauth"] = resp
 	return redirect(url_for("mainpage"))
@@ -580,15 +799,45 @@ def countdown(id):
 
 # ---- Live search API ----
 
+def search_categories(q):
+	"""Ask Twitch for categories matching a search string
+
+	Returns (complete, categories), where complete is True if Twitch had no
+	further results beyond the ones returned.
+	"""
+	cats = query("helix/search/categories", params={"query": q, "first": "50"}, token="app")
+	data = cats["data"] or ()
+	complete = len(data) < 50 and not cats.get("pagination", {}).get("cursor")
+	# Take the opportunity to learn these category IDs, for do_update's benefit. Don't
+	# make the typist wait for the database write though.
+	threading.Thread(target=remember_games, daemon=True,
+		args=([(cat["name"], cat["id"], cat["box_art_url"]) for cat in data],)).start()
+	return complete, [{"name": cat["name"], "box_art_url": cat["box_art_url"], "id": cat["id"]} for cat in data]
+
+# Category names change rarely and are the same for everyone, so searches are
+# shared across all users. The picker searches on every keystroke, so a query
+# that extends one whose results were complete can be answered by filtering.
+category_search_cache = utils.TTLCache(search_categories, ttl=3600, maxsize=5000)
+category_search_prefix_hits = 0
+
+def find_categories(q):
+	global category_search_prefix_hits
+	q = q.lower()
+	for i in range(len(q) - 1, 0, -1):
+		cached = category_search_cache.peek(q[:i])
+		if cached and cached[0]:
+			category_search_prefix_hits += 1
+			return [cat for cat in cached[1] if q in cat["name"].lower()]
+	return category_search_cache.get(q)[1]
+
 @app.route("/search/game")
 def findgame():
 	if request.args["q"] == "": return jsonify([]) # Prevent failure in Twitch API call
-	cats = query("helix/search/categories", params={"query": request.args["q"], "first": "50"}, token="bearer")
 	return jsonify([{
 		"name": cat["name"], "boxart": cat["box_art_url"], "id": cat["id"],
 		# Compatibility shims for cached clients (20200619)
 		"localized_name": cat["name"], "box": {"small": cat["box_art_url"]},
-	} for cat in cats["data"] or ()])
+	} for cat in find_categories(request.args["q"])])
 
 @app.route("/search/tag")
 def findtag():
@@ -605,6 +854,21 @@ def helloworld():
 		info["user"] = session["twitch_user"]["display_name"]
 	return jsonify(info)
 
+@app.route("/api/status")
+def server_status():
+	"""Internal counters, for monitoring"""
+	return jsonify({
+		"category_search": dict(category_search_cache.stats(), prefix_hits=category_search_prefix_hits),
+		"schedule": schedule_cache.stats(),
+		"logins": login_cache.stats(),
+		"channels": channel_cache.stats(),
+		"database_pool": database.pool.stats(),
+		"timers": database.timer_cache.stats(),
+		"scheduler": scheduler.stats(),
+		"twitch_ratelimit": dict(twitch_ratelimit.stats(),
+			app=twitch_ratelimit.state("Bearer %s" % app_token.token) if app_token.token else None),
+	})
+
 @app.route("/api/setups")
 @wants_channelid
 def list_setups(channelid):
@@ -627,42 +891,56 @@ def delete_setup(channelid, setupid):
 	if deleted: return "", 204
 	return "", 404
 
-@app.route("/mustard-backup.json")
-@wants_channelid
-def make_backup(channelid):
-	twitchid = channelid
-	response = "{\n"
+def generate_backup(setups, sched_tweet, checklist, timers):
+	"""Yield the backup file piece by piece"""
+	yield "{\n"
 	# Setups
-	setups = database.list_setups(twitchid)
-	response += '\t"setups": [\n'
+	yield '\t"setups": [\n'
 	fields = "category", "title", "tags", "tweet", "ccls"
 	for setup in setups:
 		setup = {field: setup[field] for field in fields}
-		response += "\t\t" + json.dumps(setup) + ",\n"
-	response += '\t\t""\n\t],\n'
+		yield "\t\t" + json.dumps(setup) + ",\n"
+	yield '\t\t""\n\t],\n'
 	# Twitter config (formerly Schedule)
-	[sched_tweet] = database.get_twitter_config(twitchid)
-	response += '\t"twitter_config": [%d],\n' % sched_tweet
+	yield '\t"twitter_config": [%d],\n' % sched_tweet
 	# Checklist
-	checklist = database.get_checklist(twitchid).strip().split("\n")
-	response += '\t"checklist": [\n'
-	for item in checklist:
-		response += "\t\t" + json.dumps(item) + ",\n"
-	response += '\t\t""\n\t],\n' # Empty string as shim. Ignored on import.
+	yield '\t"checklist": [\n'
+	for item in checklist.strip().split("\n"):
+		yield "\t\t" + json.dumps(item) + ",\n"
+	yield '\t\t""\n\t],\n' # Empty string as shim. Ignored on import.
 	# Timers
-	timers = database.list_timers(twitchid, full=True)
-	response += '\t"timers": [\n'
+	yield '\t"timers": [\n'
 	for timer in timers:
 		item = dict(zip("id title delta maxtime styling".split(), timer))
-		response += "\t\t" + json.dumps(item) + ",\n"
-	response += '\t\t""\n\t],\n'
+		yield "\t\t" + json.dumps(item) + ",\n"
+	yield '\t\t""\n\t],\n'
 	# Footer (marker to show that the file was correctly downloaded)
 	# This must NOT include any sort of timestamp, as the backup file
 	# must be completely stable (taking two backups without changing
 	# anything should result in bit-for-bit identical files).
-	response += '\t"": "Mustard-Mine Backup"\n}\n'
-	return Response(response, mimetype="application/json",
-		headers={"Content-disposition": "attachment"})
+	yield '\t"": "Mustard-Mine Backup"\n}\n'
+
+# Bump this whenever generate_backup's output changes, so old ETags don't match
+BACKUP_FORMAT = 1
+
+@app.route("/mustard-backup.json")
+@wants_channelid
+def make_backup(channelid):
+	twitchid = channelid
+	# Since the file is a pure function of the rows it's built from, a hash of
+	# those (done in the database, which sends back just the hash) identifies
+	# it, and a client with an up-to-date copy needs nothing more than that.
+	# The hash is taken before the data is read, so a change in between at worst
+	# labels fresh data with an outdated ETag, costing one redundant download.
+	version = database.backup_hash(twitchid)
+	if version is None: return "No such user", 404
+	etag = '"%d-%s"' % (BACKUP_FORMAT, version)
+	if etag.strip('"') in request.if_none_match:
+		return Response(status=304, headers={"ETag": etag})
+	data = (database.list_setups(twitchid), database.get_twitter_config(twitchid)[0],
+		database.get_checklist(twitchid), database.list_timers(twitchid, full=True))
+	return Response(generate_backup(*data), mimetype="application/json",
+		headers={"Content-disposition": "attachment", "ETag": etag})
 
 @app.route("/restore-backup", methods=["POST"])
 @wants_channelid
@@ -690,49 +968,181 @@ document.getElementById("tz").innerHTML = "Your timezone appears to be: " + tz;
 </script>
 """
 
-# Map timer IDs to lists of sockets
-timer_sockets = collections.defaultdict(list)
+class SocketSender:
+	"""Outbound queue for one websocket, drained by its own greenlet
+
+	Broadcasting to a socket never blocks the broadcaster. A socket that
+	can't keep up (its queue fills), or that takes too long to accept a
+	message (eg a half-open TCP connection), gets closed and its pending
+	messages discarded.
+	"""
+	def __init__(self, ws, *, maxsize=32, timeout=10):
+		self.ws = ws
+		self.timeout = timeout
+		self.queue = gevent.queue.Queue(maxsize)
+		self.closed = False
+		self.greenlet = gevent.spawn(self.drain)
+
+	def send(self, message):
+		"""Queue a message, which must already be serialized"""
+		if self.closed: return
+		try: self.queue.put_nowait(message)
+		except gevent.queue.Full:
+			# Closing can block for up to the timeout; don't make the broadcaster wait
+			self.closed = True
+			self.greenlet.kill(block=False)
+			gevent.spawn(self.close)
+
+	def drain(self):
+		while True:
+			message = self.queue.get()
+			if message is None: break
+			try:
+				with gevent.Timeout(self.timeout): self.ws.send(message)
+			except (gevent.Timeout, Exception):
+				self.close()
+				break
+
+	def close(self):
+		"""Drop the connection. Its receive loop will then clean up."""
+		self.closed = True
+		if gevent.getcurrent() is not self.greenlet: self.greenlet.kill(block=False)
+		try:
+			with gevent.Timeout(self.timeout): self.ws.close()
+		except (gevent.Timeout, Exception): pass
+
+	def stop(self):
+		"""Let the queue drain normally, then finish"""
+		try: self.queue.put_nowait(None)
+		except gevent.queue.Full: self.greenlet.kill(block=False)
+
+# Map Twitch channel IDs to {timer ID: [SocketSender]}, so that a broadcast to
+# a channel is a single lookup. timer_owners maps each of those timer IDs back
+# to its channel. Sockets whose timers don't exist (or no longer do) aren't in
+# either, as nothing can ever be broadcast to them.
+channel_sockets = collections.defaultdict(dict)
+timer_owners = {}
+
+def register_socket(timerid, sender):
+	"""Add a socket to the registry; returns the timer's channel ID, or None"""
+	info = database.get_public_timer_details(timerid)
+	if not info: return None
+	channelid = info["twitchid"]
+	channel_sockets[channelid].setdefault(timerid, []).append(sender)
+	timer_owners[timerid] = channelid
+	subscribe_control(channelid)
+	return channelid
+
+def _drop_timer(timerid):
+	# Forget a timer and all its sockets; returns the number of sockets dropped.
+	channelid = timer_owners.pop(timerid)
+	senders = channel_sockets[channelid].pop(timerid)
+	if not channel_sockets[channelid]: del channel_sockets[channelid]
+	for _ in senders: unsubscribe_control(channelid)
+	return len(senders)
+
+def unregister_socket(timerid, sender):
+	channelid = timer_owners.get(timerid)
+	if channelid is None: return # Never registered, or the timer has been deleted
+	senders = channel_sockets[channelid][timerid]
+	senders.remove(sender)
+	unsubscribe_control(channelid)
+	if not senders:
+		del channel_sockets[channelid][timerid], timer_owners[timerid]
+		if not channel_sockets[channelid]: del channel_sockets[channelid]
+
+def timer_changed(timerid):
+	"""Called (via notification) when any timer changes, in any worker"""
+	if timerid == database.TIMER_FLUSH: return recheck_timers()
+	if timerid not in timer_owners: return # Not ours to worry about
+	if database.get_public_timer_details(timerid): return # Still exists
+	# Deleted. Its sockets stay open, but will no longer get broadcasts. (Check
+	# again, as its last socket may have gone while we looked it up.)
+	if timerid in timer_owners: _drop_timer(timerid)
+
+def recheck_timers():
+	"""After missing notifications, look for any deleted timers"""
+	for timerid in list(timer_owners): timer_changed(timerid)
+
+# Registered after the timer cache's own handlers, so those run first.
+database.listener.listen(database.TIMER_CHANNEL, timer_changed)
+database.listener.on_reconnect(recheck_timers)
+
+# Timer controls (adjust/force) are published to all workers via Postgres
+# notifications, one notification channel per Twitch channel. Each worker
+# listens only on the channels it has sockets for, and delivers locally.
+def control_channel(twitchid): return "mustard_ctrl_%d" % int(twitchid)
+control_listeners = {} # Twitch channel ID: [callback, number of sockets]
+
+def deliver_control(channelid, payload):
+	# The payload is already JSON, exactly as the sockets want it, so it goes out
+	# as-is. Queueing to a socket doesn't block, so neither does this.
+	for senders in list(channel_sockets.get(channelid, {}).values()):
+		for sender in senders:
+			sender.send(payload)
+
+def subscribe_control(channelid):
+	if channelid not in control_listeners:
+		callback = functools.partial(deliver_control, channelid)
+		control_listeners[channelid] = [callback, 0]
+		database.listener.listen(control_channel(channelid), callback)
+	control_listeners[channelid][1] += 1
+
+def unsubscribe_control(channelid):
+	control_listeners[channelid][1] -= 1
+	if not control_listeners[channelid][1]:
+		callback, _ = control_listeners.pop(channelid)
+		database.listener.unlisten(control_channel(channelid), callback)
+
+def publish_control(channelid, message):
+	database.publish(control_channel(channelid), json.dumps(message))
+
 @sockets.route("/countdown_ctrl")
 def control_socket(ws):
 	timerid = None
-	while not ws.closed:
-		message = ws.receive()
-		if type(message) is not str: continue # Be VERY strict here, for safety
-		try: message = json.loads(message)
-		except json.JSONDecodeError: continue
-		if type(message) is not dict: continue # Again, very strict
-		if "type" not in message: continue
-		# Okay, we have a properly-formed message.
-		if message["type"] == "init":
-			if timerid: continue # Don't initialize twice
-			if "id" not in message or not message["id"]: continue
-			timerid = message["id"]
-			timer_sockets[timerid].append(ws)
-			ws.send(json.dumps({"type": "inited"}))
-		if message["type"] == "logme":
-			# Sometimes we're working in a context that has no logging
-			# facilities available. Provide some very basic logging via
-			# the server's console. Strictly strings only, and shortish.
-			msg = message.get("msg")
-			if type(msg) is str and len(msg) < 1000:
-				print("Log message from socket: %r" % msg)
-	if timerid: timer_sockets[timerid].remove(ws)
+	sender = SocketSender(ws)
+	try:
+		while not ws.closed:
+			message = ws.receive()
+			if type(message) is not str: continue # Be VERY strict here, for safety
+			try: message = json.loads(message)
+			except json.JSONDecodeError: continue
+			if type(message) is not dict: continue # Again, very strict
+			if "type" not in message: continue
+			# Okay, we have a properly-formed message.
+			if message["type"] == "init":
+				if timerid: continue # Don't initialize twice
+				if "id" not in message or not message["id"]: continue
+				timerid = message["id"]
+				register_socket(timerid, sender)
+				sender.send(json.dumps({"type": "inited"}))
+			if message["type"] == "logme":
+				# Sometimes we're working in a context that has no logging
+				# facilities available. Provide some very basic logging via
+				# the server's console. Strictly strings only, and shortish.
+				msg = message.get("msg")
+				if type(msg) is str and len(msg) < 1000:
+					print("Log message from socket: %r" % msg)
+	finally:
+		# Clean up even if the connection died messily (eg dropped by the sender)
+		if timerid: unregister_socket(timerid, sender)
+		sender.stop()
 
 '''
 # For testing, update a single timer
 @app.route("/hack/<id>")
 def hack_timer(id):
 	# For never-used IDs, don't defaultdict a list into the mapping
-	if id not in timer_sockets: return "Nobody's using that"
-	for ws in timer_sockets[id]:
-		ws.send(json.dumps({"type": "adjust", "delta": 60}))
+	if id not in timer_owners: return "Nobody's using that"
+	for sender in channel_sockets[timer_owners[id]][id]:
+		sender.send(json.dumps({"type": "adjust", "delta": 60}))
 	return "Done"
 @app.route("/force/<id>")
 def force_timer(id):
 	# For never-used IDs, don't defaultdict a list into the mapping
-	if id not in timer_sockets: return "Nobody's using that"
-	for ws in timer_sockets[id]:
-		ws.send(json.dumps({"type": "force", "time": 900}))
+	if id not in timer_owners: return "Nobody's using that"
+	for sender in channel_sockets[timer_owners[id]][id]:
+		sender.send(json.dumps({"type": "force", "time": 900}))
 	return "Done"
 '''
 
@@ -743,20 +1153,14 @@ def force_timer(id):
 def adjust_all_timers(channelid, delta, negative=False):
 	if negative: delta = -delta # Since the int converter can't handle negatives, we do them manually.
 	if not channelid: return redirect(url_for("mainpage"))
-	for id, timer in database.list_timers(channelid):
-		if id in timer_sockets:
-			for ws in timer_sockets[id]:
-				ws.send(json.dumps({"type": "adjust", "delta": delta}))
+	publish_control(channelid, {"type": "adjust", "delta": delta})
 	return "", 204
 
 @app.route("/timer-force-all/<int:tm>")
 @wants_channelid
 def force_all_timers(channelid, tm):
 	if not channelid: return redirect(url_for("mainpage"))
-	for id, timer in database.list_timers(channelid):
-		if id in timer_sockets:
-			for ws in timer_sockets[id]:
-				ws.send(json.dumps({"type": "force", "time": tm}))
+	publish_control(channelid, {"type": "force", "time": tm})
 	return "", 204
 
 if all_ccls is None:
@@ -779,4 +1183,5 @@ if __name__ == "__main__":
 else:
 	# Worker startup. This is the place to put any actual initialization work
 	# as it won't be done on master startup.
-	pass # Don't currently need anything, actually. For now. Probably will at some point.
+	database.listener.start() # Hear about changes made by other workers
+	threading.Thread(target=tweet_dispatcher, daemon=True).start()
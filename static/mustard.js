@@ -261,8 +261,8 @@ function format_time(delay) {
 	return mm + ":" + ss;
 }
 
-async function fetch_schedule() {
-	const data = await (await fetch("/api/twitch_schedule?channelid=" + channel._id)).json();
+async function fetch_schedule(refresh) {
+	const data = await (await fetch("/api/twitch_schedule?channelid=" + channel._id + (refresh ? "&refresh=1" : ""))).json();
 	console.log("Got schedule:", data);
 	schedule = data.schedule || [];
 	if (!schedule.length) set_content("#upcoming_streams", LI("No scheduled streams - configure on your Twitch dashboard"));
@@ -273,7 +273,7 @@ async function fetch_schedule() {
 		sch.category.name ? B(" - " + sch.category.name) : "",
 	])));
 }
-on("click", "#fetch_schedule", fetch_schedule);
+on("click", "#fetch_schedule", () => fetch_schedule(true));
 fetch_schedule();
 
 function select_tweet_schedule(time) {
@@ -1,6 +1,59 @@
+import collections
+import heapq
+import os
 import queue
+import random
 import threading
 import time
+from http.cookiejar import DefaultCookiePolicy
+import requests.adapters
+
+# If gevent is in charge, jobs can be interrupted when they time out.
+try:
+	from gevent import monkey
+	if monkey.is_module_patched("threading"): from gevent import Timeout as GeventTimeout
+	else: GeventTimeout = None
+except ImportError:
+	GeventTimeout = None
+
+# Outbound HTTP tuning. These are deliberately not in config_sample.py, as
+# they have sane defaults and most deployments will never need to set them.
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "10")) # Seconds, for connect and for each read
+HTTP_POOL_HOSTS = int(os.environ.get("HTTP_POOL_HOSTS", "10")) # Number of hosts to retain pools for
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "10")) # Idle keep-alive connections kept per host
+
+class PooledAdapter(requests.adapters.HTTPAdapter):
+	"""HTTP adapter with keep-alive pools and a default timeout
+
+	A single instance is shared by every session in the process, so that any
+	request to a given host can reuse a warm connection regardless of which
+	session (and therefore which credentials) it came from. urllib3 keeps a
+	separate pool per host, and its pools are safe to share across threads
+	and across gevent greenlets.
+	"""
+	def __init__(self):
+		super().__init__(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE)
+
+	def send(self, request, timeout=None, **kw):
+		# requests has no default timeout at all; never wait forever on Twitch or Twitter.
+		if timeout is None: timeout = HTTP_TIMEOUT
+		return super().send(request, timeout=timeout, **kw)
+
+http_adapter = PooledAdapter()
+
+def pooled(session):
+	"""Attach the shared connection pools to a requests-compatible session
+
+	Returns the same session, for convenience. Works for OAuth sessions too.
+	"""
+	session.mount("https://", http_adapter)
+	session.mount("http://", http_adapter)
+	return session
+
+# General-purpose session for requests that carry their own auth. It's shared
+# by every user, so it must never remember cookies from one request to the next.
+http = pooled(requests.Session())
+http.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
 
 class ScheduleQueue(queue.PriorityQueue):
 	"""Variant of queue.PriorityQueue where the priorities are times.
@@ -30,29 +83,340 @@ class ScheduleQueue(queue.PriorityQueue):
 			return item
 
 class Scheduler:
-	"""Self-pumping schedule queue"""
-	def __init__(self):
-		self.queue = ScheduleQueue()
+	"""Self-pumping schedule queue
+
+	Jobs are indexed by ID, and optionally by an owner key (eg the credentials
+	a tweet will be sent with), so they can be found and cancelled without
+	scanning the queue. Cancelled jobs are dropped from the indexes at once,
+	and their queue entries are skipped when they come due, or purged in bulk
+	if they start to make up most of the queue.
+
+	Due jobs run concurrently, up to 'workers' at a time, so one slow job
+	doesn't hold up everything else due at the same moment. Under gevent, a
+	job that runs longer than 'timeout' seconds is interrupted. Jobs' return
+	values are discarded; a job that wants its outcome known must record it.
+	"""
+	def __init__(self, *, workers=10, timeout=60):
+		self.queue = ScheduleQueue() # Entries are (time, id)
 		self.thread = threading.Thread(target=self.pump)
 		self.thread.daemon = True
 		self.counter = 0
-		self.deleted = {}
+		self.jobs = {} # id: (time, func, id, args, owner)
+		self.owners = collections.defaultdict(dict) # owner: {id: job}
+		self.dead = 0 # Queue entries whose jobs have been removed
+		self.lock = threading.Lock()
+		self.slots = threading.BoundedSemaphore(workers)
+		self.timeout = timeout
+		self.completed = self.failed = self.max_lateness = 0
 		self.thread.start()
 
 	def pump(self):
 		while True:
-			tm, func, id, args = self.queue.wait()
+			tm, id = self.queue.wait()
 			assert tm <= time.time()
-			if self.deleted.pop(id, False): continue # Deleted event
-			func(*args)
+			with self.lock:
+				job = self._unindex(id)
+				if not job:
+					self.dead -= 1
+					continue # Deleted event
+			self.slots.acquire() # If all workers are busy, wait for one
+			threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+	def _run(self, job):
+		tm, func, id, args, owner = job
+		lateness = time.time() - tm
+		failed = False
+		try:
+			if GeventTimeout:
+				with GeventTimeout(self.timeout): func(*args)
+			else: func(*args)
+		except BaseException as e: # Including gevent.Timeout, which isn't an Exception
+			print("Scheduled job %d failed: %r" % (id, e))
+			failed = True
+		finally:
+			self.slots.release()
+		with self.lock:
+			if failed: self.failed += 1
+			else: self.completed += 1
+			self.max_lateness = max(self.max_lateness, lateness)
+
+	def stats(self):
+		return {"queued": len(self.jobs), "completed": self.completed, "failed": self.failed,
+			"max_lateness": self.max_lateness}
+
+	def _unindex(self, id):
+		# Must be called with the lock held. Returns the job, or None if not found.
+		job = self.jobs.pop(id, None)
+		if job and job[4] is not None:
+			jobs = self.owners[job[4]]
+			del jobs[id]
+			if not jobs: del self.owners[job[4]]
+		return job
+
+	def put(self, tm, func, *args, owner=None):
+		with self.lock:
+			self.counter += 1
+			id = self.counter
+			job = self.jobs[id] = (tm, func, id, args, owner)
+			if owner is not None: self.owners[owner][id] = job
+			self.queue.put((tm, id))
+		return id
+
+	def search(self, func, owner=None):
+		"""Return a list of all queued calls to a given function
+
+		If owner is given, only that owner's jobs will be examined, which is
+		much faster than looking at everything.
+		"""
+		with self.lock:
+			jobs = self.jobs if owner is None else self.owners.get(owner, {})
+			return sorted((t, i, a) for t, f, i, a, o in jobs.values() if f is func)
+
+	def remove(self, id, owner=None):
+		"""Cancel a job. If owner is given, the job must belong to it.
+
+		Returns True if the job was found and removed.
+		"""
+		with self.lock:
+			job = self.jobs.get(id)
+			if not job or (owner is not None and job[4] != owner): return False
+			self._unindex(id)
+			self.dead += 1
+			if self.dead > 1000 and self.dead > len(self.queue.queue) // 2:
+				# Most of the queue is cancelled jobs; rebuild it with just the live ones.
+				with self.queue.mutex:
+					self.queue.queue = [entry for entry in self.queue.queue if entry[1] in self.jobs]
+					heapq.heapify(self.queue.queue)
+				self.dead = 0
+		return True
+
+class _Flight:
+	"""One in-progress fetch, which any number of callers can wait on"""
+	def __init__(self, generation):
+		self.generation = generation
+		self.done = threading.Event()
+		self.value = self.error = None
+		self.interrupted = False
+
+class TTLCache:
+	"""Keyed read-through cache with expiry and request coalescing
+
+	cache.get(key) returns a value no older than ttl seconds, calling
+	fetch(key) to obtain it if necessary. If several callers miss on the
+	same key at once, only one of them calls fetch; the rest wait for it
+	and share its result (or its exception). A value that has expired, but
+	by no more than 'stale' seconds, is returned immediately while a fresh
+	one is fetched in the background.
+
+	If maxsize is given, the least recently used entries are evicted once
+	the cache grows beyond that many keys. A fetch that returns None (eg
+	for a key that doesn't exist) is kept for negative_ttl seconds instead,
+	which defaults to ttl; if it's zero, None is never cached, so lookups
+	of junk keys can't push real entries out.
+	"""
+	def __init__(self, fetch, *, ttl, stale=0, maxsize=None, negative_ttl=None):
+		self.fetch = fetch
+		self.ttl = ttl
+		self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+		self.stale = stale
+		self.maxsize = maxsize
+		self.entries = collections.OrderedDict() # key: (value, time fetched)
+		self.pending = {} # key: _Flight
+		self.generation = 0 # Bumped on invalidation so in-flight fetches don't store old data
+		self.lock = threading.Lock()
+		self.hits = self.misses = 0
+
+	def get(self, key):
+		now = time.time()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry and now < entry[1] + self._ttl(entry[0]):
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry[0]
+			self.misses += 1
+			flight = self.pending.get(key)
+			leader = flight is None
+			if leader: flight = self.pending[key] = _Flight(self.generation)
+		if entry and now < entry[1] + self._ttl(entry[0]) + self.stale:
+			# Stale but usable. Revalidate in the background (unless someone
+			# else already is) and let the caller have the old value now.
+			if leader: threading.Thread(target=self._fetch, args=(key, flight), daemon=True).start()
+			return entry[0]
+		if leader: self._fetch(key, flight)
+		else: flight.done.wait()
+		if flight.interrupted: return self.get(key) # Only a waiter can get here
+		if flight.error: raise flight.error
+		return flight.value
+
+	def peek(self, key):
+		"""Return a fresh cached value without fetching, or None if there isn't one"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry and time.time() < entry[1] + self._ttl(entry[0]):
+				self.entries.move_to_end(key)
+				return entry[0]
+		return None
+
+	def _ttl(self, value):
+		return self.negative_ttl if value is None else self.ttl
+
+	def _fetch(self, key, flight):
+		try:
+			flight.value = self.fetch(key)
+		except Exception as e:
+			flight.error = e
+		except BaseException:
+			# The fetching thread itself was stopped (eg killed, or timed out).
+			# That's its own business; anyone waiting on it will try again.
+			flight.interrupted = True
+			raise
+		finally:
+			with self.lock:
+				if self.pending.get(key) is flight: del self.pending[key]
+				if not flight.error and not flight.interrupted and flight.generation == self.generation:
+					self._store(key, flight.value)
+			flight.done.set()
+
+	def _store(self, key, value):
+		# Must be called with the lock held
+		if value is None and not self.negative_ttl:
+			self.entries.pop(key, None)
+			return
+		self.entries[key] = (value, time.time())
+		self.entries.move_to_end(key)
+		if self.maxsize is not None:
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+	def set(self, key, value):
+		"""Store a known-current value, eg after writing it upstream
+
+		Like invalidate(), this stops any fetch already in flight from
+		replacing the new value with what it read before the write.
+		"""
+		with self.lock:
+			self.generation += 1
+			self.pending.pop(key, None)
+			self._store(key, value)
+
+	def stats(self):
+		return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+	def invalidate(self, key=None):
+		"""Discard one cached key, or everything if no key is given
+
+		Any fetch already in flight will still be returned to the callers
+		waiting on it, but will not be retained, and later callers won't
+		join it; they get a fetch that started after the invalidation.
+		"""
+		with self.lock:
+			self.generation += 1
+			if key is None:
+				self.entries.clear()
+				self.pending.clear()
+			else:
+				self.entries.pop(key, None)
+				self.pending.pop(key, None)
+
+class _Batch:
+	def __init__(self):
+		self.keys = []
+		self.full = threading.Event()
+		self.done = threading.Event()
+		self.results = {}
+		self.error = None
+
+class Batcher:
+	"""Coalesce concurrent single-key lookups into batched calls
+
+	batcher.get(key) waits briefly (delay seconds) for other callers to join
+	in, then calls fetch_many(keys) once for everyone, up to maxbatch keys
+	at a time. fetch_many must return a dict; any key it omits gets None.
+	"""
+	def __init__(self, fetch_many, *, maxbatch=100, delay=0.01):
+		self.fetch_many = fetch_many
+		self.maxbatch = maxbatch
+		self.delay = delay
+		self.batch = None # The batch currently accepting keys
+		self.lock = threading.Lock()
+
+	def get(self, key):
+		with self.lock:
+			batch = self.batch
+			if batch is None:
+				batch = self.batch = _Batch()
+				threading.Thread(target=self._run, args=(batch,), daemon=True).start()
+			if key not in batch.keys: batch.keys.append(key)
+			if len(batch.keys) >= self.maxbatch:
+				self.batch = None # Nobody else can join; send it right away
+				batch.full.set()
+		batch.done.wait()
+		if batch.error: raise batch.error
+		return batch.results.get(key)
+
+	def _run(self, batch):
+		batch.full.wait(self.delay)
+		with self.lock:
+			if self.batch is batch: self.batch = None
+		try: batch.results = self.fetch_many(batch.keys)
+		except Exception as e: batch.error = e
+		batch.done.set()
+
+class RateLimiter:
+	"""Track token-bucket rate limits as advertised by Ratelimit-* headers
+
+	Each bucket is identified by an arbitrary key (eg the auth token used).
+	Call wait(key) before making a request, update(key, headers) after it,
+	and retry_delay(key) to find out how long to back off after a 429.
+	"""
+	def __init__(self, *, reserve=1, maxwait=15, maxsize=1000):
+		self.reserve = reserve # Start delaying when the bucket gets down to this many
+		self.maxwait = maxwait # Never delay a single request for longer than this
+		self.maxsize = maxsize
+		self.buckets = collections.OrderedDict() # key: [limit, remaining, reset time]
+		self.lock = threading.Lock()
+		self.delayed = self.throttled = 0
+
+	def wait(self, key):
+		"""Delay, if necessary, until a request on this bucket should be accepted"""
+		with self.lock:
+			bucket = self.buckets.get(key)
+			if not bucket: return
+			delay = bucket[2] - time.time()
+			if delay <= 0 or bucket[1] > self.reserve:
+				# Assume this request will consume a point, so that concurrent
+				# callers don't all see the same count and pile in together.
+				bucket[1] -= 1
+				return
+			self.delayed += 1
+		time.sleep(min(delay, self.maxwait) + random.uniform(0, 0.25))
+
+	def update(self, key, headers):
+		"""Record the bucket state reported in a response's headers"""
+		try:
+			state = [int(headers["Ratelimit-Limit"]), int(headers["Ratelimit-Remaining"]), int(headers["Ratelimit-Reset"])]
+		except (KeyError, ValueError):
+			return # No (usable) rate limit info in this response
+		with self.lock:
+			self.buckets[key] = state
+			self.buckets.move_to_end(key)
+			while len(self.buckets) > self.maxsize:
+				self.buckets.popitem(last=False)
 
-	def put(self, tm, func, *args):
-		self.counter += 1
-		return self.queue.put((tm, func, self.counter, args))
+	def retry_delay(self, key):
+		"""Seconds to wait before retrying after being throttled"""
+		self.throttled += 1
+		with self.lock: bucket = self.buckets.get(key)
+		delay = bucket[2] - time.time() if bucket else 1
+		# Jitter ensures that everyone who got throttled doesn't retry at the same instant
+		return min(max(delay, 0), self.maxwait) + random.uniform(0, 1)
 
-	def search(self, func):
-		"""Return a list of all queued calls to a given function"""
-		return [(t, i, a) for t, f, i, a in self.queue.queue if f is func and i not in self.deleted]
+	def state(self, key):
+		"""Current bucket state for one key, or None if nothing known"""
+		with self.lock: bucket = self.buckets.get(key)
+		if not bucket: return None
+		return {"limit": bucket[0], "remaining": bucket[1], "reset": bucket[2]}
 
-	def remove(self, id):
-		self.deleted[id] = True
+	def stats(self):
+		return {"buckets": len(self.buckets), "delayed": self.delayed, "throttled": self.throttled}